@@ -40,7 +40,6 @@ from psychopy import visual, event, core, logging, prefs, monitors
 from psychopy.tools.coordinatetools import pol2cart
 from math import sin, cos, pi
 from PIL import Image, ImageDraw
-from psychopy.sound import Sound
 
 
 #allow to disable sound, or if we failed to initialize pygame.mixer or failed to load audio file
@@ -159,6 +158,7 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
         # Configure calibration sounds (beeps), use ".wav" files
         if not DISABLE_AUDIO:
             try:
+                from psychopy.sound import Sound  # slow to import, so only when beeps are used
                 self._target_beep = Sound('type.wav', stereo=True)
                 self._error_beep = Sound('error.wav', stereo=True)
                 self._done_beep = Sound('qbeep.wav', stereo=True)
@@ -0,0 +1,52 @@
+import numpy as np
+
+def read_asc_samples(path):
+    """Gaze samples from an edf2asc file as an (n, 3) array of (time, x, y).
+
+    Time is in seconds on the tracker clock and position in tracker pixels.
+    Samples with missing gaze (e.g. blinks) are skipped.
+    """
+    rows = []
+    with open(path) as f:
+        for line in f:
+            if not line[:1].isdigit():
+                continue
+            fields = line.split()
+            try:
+                rows.append((float(fields[0]) / 1000, float(fields[1]), float(fields[2])))
+            except (ValueError, IndexError):
+                continue  # missing data is written as '.'
+    return np.array(rows).reshape(-1, 3)
+
+def read_asc_messages(path):
+    """(time, text) for every MSG line in an edf2asc file."""
+    messages = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith('MSG'):
+                _, t, text = line.rstrip('\n').split(None, 2)
+                messages.append((float(t) / 1000, text))
+    return messages
+
+def read_asc_events(path):
+    """Fixations and saccades from an edf2asc file as an (n, 7) array.
+
+    Each row is (kind, start, end, x0, y0, x1, y1), with kind 0 for a
+    fixation and 1 for a saccade, times in seconds on the tracker clock and
+    positions in tracker pixels. A fixation's start and end positions are
+    both its average position.
+    """
+    rows = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            try:
+                if line.startswith('EFIX'):
+                    start, end, _, x, y = map(float, fields[2:7])
+                    rows.append((0, start / 1000, end / 1000, x, y, x, y))
+                elif line.startswith('ESACC'):
+                    start, end, _, x0, y0, x1, y1 = map(float, fields[2:9])
+                    rows.append((1, start / 1000, end / 1000, x0, y0, x1, y1))
+            except (ValueError, IndexError):
+                continue  # missing data is written as '.'
+    return np.array(rows).reshape(-1, 7)
@@ -0,0 +1,173 @@
+"""Per-frame CPU cost of GraphTrial and CalibrationTrial, run headless.
+
+    python benchmark.py run                       # writes benchmarks/{sha}.json
+    python benchmark.py compare OLD.json NEW.json  # exits 1 on a regression
+"""
+import os
+import sys
+import json
+import time
+import platform
+from datetime import datetime
+import numpy as np
+
+from headless import headless
+from trial import GraphTrial, CalibrationTrial
+from buffers import ColumnBuffer
+from util import jsonify, git_sha
+
+TIMED = ('update_fixation', 'get_click', 'check_click', 'tick', 'set_node_label', 'log')
+
+class FrameProfile(object):
+    """CPU time per frame spent in some of a trial's methods.
+
+    Times are inclusive, e.g. check_click includes the set_state it triggers.
+    A frame ends with each tick(); 'frame' is the time since the previous one.
+    """
+    def __init__(self, names=TIMED):
+        self.names = names
+        self.frames = ColumnBuffer(names + ('frame',))
+        self.current = dict.fromkeys(names, 0.)
+        self.last = None
+
+    def attach(self, trial):
+        for name in self.names:
+            self._wrap(trial, name)
+        self.last = time.perf_counter()
+
+    def _wrap(self, trial, name):
+        f = getattr(trial, name)
+        def timed(*args, **kws):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kws)
+            finally:
+                end = time.perf_counter()
+                self.current[name] += end - start
+                if name == 'tick':
+                    self.frames.append(*self.current.values(), end - self.last)
+                    self.current = dict.fromkeys(self.names, 0.)
+                    self.last = end
+        setattr(trial, name, timed)
+
+    def summary(self):
+        us = 1e6 * self.frames.array()
+        return {
+            name: {
+                'mean_us': round(float(x.mean()), 2),
+                'p50_us': round(float(np.percentile(x, 50)), 2),
+                'p95_us': round(float(np.percentile(x, 95)), 2),
+                'max_us': round(float(x.max()), 2),
+            }
+            for name, x in zip(self.frames.columns, us.T)
+        }
+
+
+def random_problem(n, rng, max_children=2):
+    """A random DAG with n nodes laid out on a circle, like the configs."""
+    angles = np.pi / 2 + 2 * np.pi * np.arange(n) / n
+    layout = .5 * np.column_stack([np.cos(angles), np.sin(angles)])
+    order = rng.permutation(n)
+    graph = [[] for _ in range(n)]
+    for k, i in enumerate(order[:-1]):
+        later = order[k+1:]
+        graph[i] = [int(j) for j in rng.choice(later, min(max_children, len(later)), replace=False)]
+    rewards = rng.choice([-8, -4, -2, -1, 1, 2, 4, 8], n).astype(float)
+    return {'graph': graph, 'rewards': rewards.tolist(), 'start': int(order[0]), 'layout': layout.tolist()}
+
+
+def run_case(kind='graph', n_nodes=11, gaze_contingent=False, highlight_edges=False, batch_render=False,
+             n_trials=5, act_time=15, seed=0):
+    rng = np.random.default_rng(seed)
+    profile = FrameProfile()
+    start = time.perf_counter()
+    with headless(seed=seed) as (win, driver):
+        for i in range(n_trials):
+            problem = random_problem(n_nodes, rng)
+            if kind == 'calibration':
+                gt = CalibrationTrial(win, **problem, batch_render=batch_render, eyelink=driver.link)
+            else:
+                gt = GraphTrial(win, **problem, act_time=act_time, gaze_contingent=gaze_contingent,
+                                highlight_edges=highlight_edges, batch_render=batch_render, eyelink=driver.link)
+            driver.attach(gt)
+            profile.attach(gt)
+            gt.run()
+    return {
+        'kind': kind,
+        'n_nodes': n_nodes,
+        'gaze_contingent': gaze_contingent,
+        'highlight_edges': highlight_edges,
+        'batch_render': batch_render,
+        'n_trials': n_trials,
+        'n_frames': len(profile.frames),
+        'wall_sec': round(time.perf_counter() - start, 3),
+        'per_frame': profile.summary(),
+    }
+
+
+def run(out=None, sizes=(11, 25, 50, 100), n_trials=5, batch_render=False, seed=0):
+    """Sweeps graph size, gaze contingency and edge highlighting, then a calibration trial."""
+    cases = [dict(n_nodes=n, gaze_contingent=gc, highlight_edges=he)
+             for n in sizes for gc in (False, True) for he in (False, True)]
+    # CalibrationTrial keeps failure counts for the 11 nodes of the real layout
+    cases.append(dict(kind='calibration', n_nodes=11, gaze_contingent=True))
+
+    results = []
+    for case in cases:
+        result = run_case(**case, batch_render=batch_render, n_trials=n_trials, seed=seed)
+        results.append(result)
+        frame = result['per_frame']['frame']
+        print(f"{result['kind']:11} n={result['n_nodes']:<4} gaze_contingent={result['gaze_contingent']!s:5} "
+              f"highlight_edges={result['highlight_edges']!s:5}  {result['n_frames']:5} frames  "
+              f"{frame['mean_us']:8.1f} us mean  {frame['p95_us']:8.1f} us p95")
+
+    sha = git_sha()
+    report = {
+        'git_sha': sha,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if out is None:
+        out = f'benchmarks/{sha[:10]}.json'
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as f:
+        f.write(jsonify(report))
+    print('wrote', out)
+
+
+def _case_key(result):
+    return tuple(result[k] for k in ('kind', 'n_nodes', 'gaze_contingent', 'highlight_edges', 'batch_render'))
+
+def compare(old, new, stat='mean_us', threshold=1.25):
+    """Prints new / old for every case and method; exits 1 if any ratio exceeds threshold."""
+    with open(old) as f:
+        old = json.load(f)
+    with open(new) as f:
+        new = json.load(f)
+    print(f"{old['git_sha'][:10]} -> {new['git_sha'][:10]} ({stat})")
+    baseline = {_case_key(r): r for r in old['results']}
+    regressions = 0
+    for result in new['results']:
+        key = _case_key(result)
+        if key not in baseline:
+            continue
+        ratios = []
+        for name, x in result['per_frame'].items():
+            before = baseline[key]['per_frame'].get(name, {}).get(stat)
+            if not before:
+                continue
+            ratio = x[stat] / before
+            flag = '!' if ratio > threshold else ''
+            regressions += bool(flag)
+            ratios.append(f'{name} {ratio:.2f}{flag}')
+        print(' '.join(map(str, key)), ' '.join(ratios))
+    if regressions:
+        print(f'{regressions} regressions over {threshold}x')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    from fire import Fire
+    Fire({'run': run, 'compare': compare})
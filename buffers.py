@@ -0,0 +1,106 @@
+import numpy as np
+
+class ColumnBuffer(object):
+    """Growable float64 table with named columns, stored contiguously.
+
+    Rows are written into a preallocated array that doubles in size when
+    full, so appending doesn't create a Python object per value and the
+    whole buffer can be serialized with a single tolist() call.
+    """
+    def __init__(self, columns, capacity=1024):
+        self.columns = tuple(columns)
+        self._data = np.empty((capacity, len(self.columns)))
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return self.array()[i]
+
+    def append(self, *row):
+        if self.n == len(self._data):
+            self._data = np.concatenate([self._data, np.empty_like(self._data)])
+        self._data[self.n] = row
+        self.n += 1
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=float).reshape(-1, len(self.columns))
+        while self.n + len(rows) > len(self._data):
+            self._data = np.concatenate([self._data, np.empty_like(self._data)])
+        self._data[self.n:self.n + len(rows)] = rows
+        self.n += len(rows)
+
+    def array(self):
+        return self._data[:self.n]
+
+    def column(self, name):
+        return self._data[:self.n, self.columns.index(name)]
+
+    def values(self):
+        """Like array(), but one-column buffers are flattened."""
+        x = self.array()
+        return x[:, 0] if len(self.columns) == 1 else x
+
+    def tolist(self):
+        return self.values().tolist()
+
+
+class MouseTrace(ColumnBuffer):
+    """Mouse positions as (time, x, y) rows.
+
+    With mode='changes' (the default), a row is only added when the position
+    differs from the previous one, i.e. each position holds until the time of
+    the next row. With mode='all', every sample is kept.
+    """
+    def __init__(self, mode='changes', capacity=256):
+        assert mode in ('changes', 'all'), mode
+        super().__init__(('time', 'x', 'y'), capacity)
+        self.mode = mode
+        self.last = None
+
+    def record(self, t, pos):
+        x, y = pos
+        if self.mode == 'changes' and self.last == (x, y):
+            return
+        self.last = (x, y)
+        self.append(t, x, y)
+
+    def position_at(self, t):
+        """Position at time t (the most recent row at or before t)."""
+        i = np.searchsorted(self.column('time'), t, side='right') - 1
+        return None if i < 0 else self.array()[i, 1:]
+
+
+class RingBuffer(object):
+    """Fixed-capacity float64 table that keeps only the most recent rows."""
+    def __init__(self, columns, capacity=4096):
+        self.columns = tuple(columns)
+        self._data = np.empty((capacity, len(self.columns)))
+        self.n = 0  # total rows ever written
+
+    def __len__(self):
+        return min(self.n, len(self._data))
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=float).reshape(-1, len(self.columns))
+        cap = len(self._data)
+        if len(rows) >= cap:
+            rows = rows[-cap:]
+            self.n += len(rows)
+            self._data[:] = np.roll(rows, self.n % cap, axis=0)
+            return
+        idx = (self.n + np.arange(len(rows))) % cap
+        self._data[idx] = rows
+        self.n += len(rows)
+
+    def array(self):
+        """Rows in the order they were written (a copy)."""
+        cap = len(self._data)
+        if self.n <= cap:
+            return self._data[:self.n].copy()
+        start = self.n % cap
+        return np.concatenate([self._data[start:], self._data[:start]])
+
+    def last(self, k):
+        return self.array()[-k:]
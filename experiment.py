@@ -1,20 +1,23 @@
 import os
 import logging
 import json
-import re
 from datetime import datetime
+from functools import cached_property
 import psychopy
 from psychopy import core, visual, gui, data, event
 from psychopy.tools.filetools import fromFile, toFile
 import numpy as np
 
-from util import jsonify
+from util import jsonify, git_sha
 from trial import GraphTrial, CalibrationTrial, COLOR_ACT, COLOR_PLAN
-from graphics import Graphics
+from graphics import Graphics, update, measure_frame_rate
 from bonus import Bonus
-from eyetracking import EyeLink, MouseLink
+from session import SessionWriter, HDF5SessionWriter
+from trialbank import load_bank
+from ledger import Ledger
+from solver import max_score
+from scheduler import Scheduler
 
-import subprocess
 from copy import deepcopy
 from config import VERSION
 import os
@@ -48,57 +51,96 @@ def stage(f):
                 logging.warning(f'Retrying {stage}')
                 f(self, *args, **kwargs)
         finally:
+            self.write_practice_data()
             self.win.clearAutoDraw()
             self.win.flip()
 
     return wrapper
 
-def get_next_config_number():
-    used = set()
-    for fn in os.listdir(DATA_PATH):
-        m = re.match(r'.*_P(\d+)\.', fn)
-        if m:
-            used.add(int(m.group(1)))
-
-    possible = range(1, 1 + len(os.listdir(CONFIG_PATH)))
-    try:
-        n = next(i for i in possible if i not in used)
-        return n
-    except StopIteration:
-        print("WARNING: USING RANDOM CONFIGURATION NUMBER")
-        return np.random.choice(list(possible))
+def open_ledger(bank=None):
+    """The session ledger, with this version's configs and any sessions from before it was kept."""
+    ledger = Ledger()
+    if bank is not None:
+        ledger.register_configs(VERSION, bank.config_numbers)
+    else:
+        ledger.register_configs(VERSION, range(1, 1 + len(os.listdir(CONFIG_PATH))))
+    ledger.backfill(VERSION, DATA_PATH)
+    return ledger
+
+def claim_config(ledger, make_id, config_number=None, holds=True, tries=5):
+    """Claims a config in the ledger and returns (session id, config_number).
+
+    If the ledger is on storage without working locks, or another rig keeps
+    its own ledger, two rigs can still pick the same config. So a claimed
+    config is checked against the session files in DATA_PATH, which may have
+    synced from other rigs, and claimed again if another session has it.
+    """
+    for attempt in range(tries):
+        session_id, n = ledger.claim(VERSION, make_id, config_number, holds=holds)
+        if config_number is not None or not holds or not os.path.isdir(DATA_PATH):
+            break
+        # our own file isn't written yet, so even one with our id is another rig's
+        taken = [fn for fn in os.listdir(DATA_PATH) if os.path.splitext(fn)[0].endswith(f'_P{n}')]
+        if not taken:
+            break
+        if attempt == tries - 1:
+            logging.warning('config %s is already used by %s, but so is every other config tried; using it anyway',
+                            n, taken[0])
+            break
+        logging.warning('config %s is already used by %s; claiming another', n, taken[0])
+        ledger.release(session_id)
+        for fn in taken:
+            ledger.add_session(VERSION, f'{DATA_PATH}/{fn}')
+    return session_id, n
+
+def get_next_config_number(bank=None):
+    return open_ledger(bank).next_free(VERSION)
 
 
 class Experiment(object):
-    def __init__(self, config_number, name=None, full_screen=False, score_limit=400, **kws):
-        if config_number is None:
-            config_number = get_next_config_number()
+    def __init__(self, config_number, name=None, full_screen=False, score_limit=400, data_format='jsonl', rotate_edf=False, **kws):
+        bank = load_bank(CONFIG_PATH)
+        timestamp = datetime.now().strftime('%y-%m-%d-%H%M')
+        def make_id(config_number):
+            return f'{timestamp}_P{config_number}' + (f'-{name}' if name else '')
+
+        self.ledger = open_ledger(bank)
+        self.id, config_number = claim_config(self.ledger, make_id, config_number, holds=not name)
         self.config_number = config_number
         print('>>>', self.config_number)
         self.full_screen = full_screen
         self.score_limit = score_limit
-
-        timestamp = datetime.now().strftime('%y-%m-%d-%H%M')
-        self.id = f'{timestamp}_P{config_number}'
-        if name:
-            self.id += '-' + str(name)
+        self.rotate_edf = rotate_edf
 
         self.setup_logging()
-        logging.info('git SHA: ' + subprocess.getoutput('git rev-parse HEAD'))
-
-        config_file = f'{CONFIG_PATH}/{config_number}.json'
-        logging.info('Configuration file: ' + config_file)
-        with open(config_file) as f:
-            conf = json.load(f)
-            self.trials = conf['trials']
-            self.parameters = conf['parameters']
-            self.parameters['gaze_contingent'] = False
+        logging.info('git SHA: ' + git_sha())
+
+        if bank is not None and config_number in bank:
+            logging.info(f'Configuration {config_number} from {bank.path}')
+            conf = bank.load(config_number)
+        else:
+            config_file = f'{CONFIG_PATH}/{config_number}.json'
+            logging.info('Configuration file: ' + config_file)
+            with open(config_file) as f:
+                conf = json.load(f)
+        self.trials = conf['trials']
+        self.parameters = conf['parameters']
+        self.parameters['gaze_contingent'] = False
         self.parameters.update(kws)
         logging.info('parameters %s', self.parameters)
 
         # if 'gaze_tolerance' not in self.parameters:
         self.parameters['gaze_tolerance'] = 1
 
+        if data_format == 'hdf5':
+            self.session = HDF5SessionWriter(f'{DATA_PATH}/{self.id}.h5', id=self.id,
+                                             config_number=config_number, parameters=self.parameters)
+        else:
+            self.session = SessionWriter(f'{DATA_PATH}/{self.id}.jsonl', id=self.id,
+                                         config_number=config_number, parameters=self.parameters)
+        self.ledger.update(self.id, data_path=self.session.path, log_path=f'{LOG_PATH}/{self.id}.log',
+                           eyelink_path=f'data/eyelink/{self.id}')
+
         self.win = self.setup_window()
         self.bonus = Bonus(0, 50)
         self.total_score = 0
@@ -106,13 +148,9 @@ class Experiment(object):
         self.eyelink = None
         self.disable_gaze_contingency = False
 
-        self._message = visual.TextBox2(self.win, '', pos=(-.83, 0), color='white', autoDraw=True, size=(0.65, None), letterHeight=.035, anchor='left')
-        self._tip = visual.TextBox2(self.win, '', pos=(-.83, -0.2), color='white', autoDraw=True, size=(0.65, None), letterHeight=.025, anchor='left')
-
         # self._practice_trials = iter(self.trials['practice'])
         self.practice_i = -1
-        self.trial_data = []
-        self.practice_data = []
+        self.practice_data = []  # written to the session file at the end of each stage
 
     def do_survey(self, launch=True, wait=True):
         # ?assignmentId=survey&workerId=fredtest
@@ -158,6 +196,12 @@ class Experiment(object):
             **self.trials['practice'][self.practice_i],
             **kws
         }
+        # the feedback in practice() compares against this, so don't just trust the config
+        best = max_score(prm)
+        if prm.get('max_score') != best:
+            logging.warning('practice trial %s has max_score %s, but the best path scores %s',
+                            self.practice_i, prm.get('max_score'), best)
+            prm['max_score'] = best
         gt = GraphTrial(self.win, **prm)
         self.practice_data.append(gt.data)
         return gt
@@ -191,8 +235,7 @@ class Experiment(object):
     def setup_window(self):
         size = (1350,750)
         win = visual.Window(size, allowGUI=True, units='height', fullscr=self.full_screen)
-        # framerate = win.getActualFrameRate(threshold=1, nMaxFrames=1000)
-        # assert abs(framerate - 60) < 2
+        self.frame_rate = measure_frame_rate(win, f'{LOG_PATH}/frame_rates.json')
         win.flip()
         # win.callOnFlip(self.on_flip)
         return win
@@ -204,6 +247,15 @@ class Experiment(object):
 
         self.win.callOnFlip(self.on_flip)
 
+    # created on first use, since laying out a TextBox2 is slow
+    @cached_property
+    def _message(self):
+        return visual.TextBox2(self.win, '', pos=(-.83, 0), color='white', autoDraw=True, size=(0.65, None), letterHeight=.035, anchor='left')
+
+    @cached_property
+    def _tip(self):
+        return visual.TextBox2(self.win, '', pos=(-.83, -0.2), color='white', autoDraw=True, size=(0.65, None), letterHeight=.025, anchor='left')
+
     def hide_message(self):
         self._message.autoDraw = False
         self._tip.autoDraw = False
@@ -264,18 +316,18 @@ class Experiment(object):
 
         self.message("Before you can move, you have to click the red circle.", space=False,
                      tip_text='click the red circle to continue')
-        gt.nodes[gt.start].setLineColor('#FFC910')
+        update(gt.nodes[gt.start], 'setLineColor', '#FFC910')
         gt.run_planning()
-        gt.nodes[gt.start].setLineColor('black')
+        update(gt.nodes[gt.start], 'setLineColor', 'black')
 
-        gt.nodes[gt.start].fillColor = COLOR_ACT
+        update(gt.nodes[gt.start], 'fillColor', COLOR_ACT)
         self.message("It will turn blue, indicating that you have entered the movement phase.", space=True)
 
         gt.hide_rewards()
         self.message("But be warned! The points will also disappear!", space=True)
 
         gt.update_node_labels()
-        gt.nodes[gt.start].fillColor = COLOR_PLAN
+        update(gt.nodes[gt.start], 'fillColor', COLOR_PLAN)
         self.message("So, you should only enter the movement phase after deciding on a full path.", space=True)
         self.message("Give it a shot!", tip_text='click the red circle', space=False)
 
@@ -345,13 +397,19 @@ class Experiment(object):
         self.message("Great job!", space=True)
 
     @stage
-    def setup_eyetracker(self, mouse=False):
+    def setup_eyetracker(self, mouse=False, sim=False):
+        """sim=True (or a dict of SimLink options) uses a simulated tracker."""
         self.message("Now we're going to calibrate the eyetracker. Please tell the experimenter.",
             tip_text="Wait for the experimenter (space)", space=True)
         self.hide_message()
-        if mouse:
+        if sim:
+            from simlink import SimLink
+            self.eyelink = SimLink(self.win, self.id, **(sim if isinstance(sim, dict) else {}))
+        elif mouse:
+            from eyetracking import MouseLink
             self.eyelink = MouseLink(self.win, self.id)
         else:
+            from eyetracking import EyeLink
             self.eyelink = EyeLink(self.win, self.id)
         self.eyelink.setup_calibration()
         self.eyelink.calibrate()
@@ -495,7 +553,7 @@ class Experiment(object):
         gt = GraphTrial(self.win, **prm, eyelink=self.eyelink)
         gt.run()
         self.bonus.add_points(gt.score)
-        self.trial_data.append(gt.data)
+        self.session.write_trial('main', gt.data)
 
     def center_message(self, msg, space=True):
         visual.TextBox2(self.win, msg, color='white', letterHeight=.035).draw()
@@ -503,12 +561,17 @@ class Experiment(object):
         event.waitKeys(keyList=['space'])
 
     @stage
-    def run_main(self, n=None):
+    def run_main(self, n=None, schedule=False):
+        """schedule=True (or a dict of Scheduler options) picks trials adaptively instead of in order."""
         summarize_every = 10000
         # summarize_every = self.parameters.get('summarize_every', 5)
 
+        scheduler = None
         trials = self.trials['main']
-        if n is not None:
+        if schedule:
+            options = {'seed': self.config_number, **(schedule if isinstance(schedule, dict) else {})}
+            scheduler = trials = Scheduler(trials, self.score_limit - self.total_score, max_trials=n, **options)
+        elif n is not None:
             trials = trials[:n]
 
         block_earned = 0
@@ -533,7 +596,12 @@ class Experiment(object):
                 gt = GraphTrial(self.win, **prm, eyelink=self.eyelink)
                 gt.run()
                 psychopy.logging.flush()
-                self.trial_data.append(gt.data)
+                if scheduler:
+                    score = gt.score if gt.status != 'recalibrate' else None
+                    scheduler.update(score)
+                    gt.data['schedule'] = {**scheduler.choices[-1], 'score': score,
+                                           'config_path': CONFIG_PATH, 'config_number': self.config_number}
+                self.session.write_trial('main', gt.data)
 
                 if gt.status != 'recalibrate':
                     block_earned += gt.score
@@ -558,6 +626,8 @@ class Experiment(object):
                 
                 calibrate_every = 20
                 if i % calibrate_every == (calibrate_every - 1):
+                    if self.rotate_edf and self.eyelink:
+                        self.eyelink.rotate_data_file()
                     if self.total_score < 0.9 * self.score_limit:
                         self.calibrate_gaze_tolerance()
 
@@ -588,20 +658,28 @@ class Experiment(object):
                     continue
                 else:
                     return
+        else:  # not aborted; the scheduler stops as soon as the limit is hit, before the check above
+            if self.score_limit and self.total_score >= self.score_limit:
+                self.center_message(f"Congratulations! You hit {self.score_limit} points!")
+
+    def write_practice_data(self):
+        for data in self.practice_data:
+            self.session.write_trial('practice', data)
+        self.practice_data = []
 
     @property
-    def all_data(self):
+    def summary(self):
         return {
             'config_number': self.config_number,
             'parameters': self.parameters,
-            'trial_data': self.trial_data,
-            'practice_data': self.practice_data,
             'window': self.win.size,
-            'bonus': self.bonus.dollars()
+            'bonus': self.bonus.dollars(),
+            'total_score': self.total_score,
         }
 
     @stage
-    def save_data(self, survey=False):
+    def save_data(self, survey=False, status='complete'):
+        """status goes in both the session file's footer and the ledger."""
         if survey:
             self.message("You're done! Before you go, we have a quick survey. Press space to open it.", space=True)
             self.message("Opening survey...", space=False)
@@ -615,10 +693,10 @@ class Experiment(object):
         logging.info("Saving data...")
         psychopy.logging.flush()
 
-        fp = f'{DATA_PATH}/{self.id}.json'
-        with open(fp, 'w') as f:
-            f.write(jsonify(self.all_data))
-        logging.info('wrote %s', fp)
+        if not self.session.closed:  # a failed first attempt may have got this far
+            self.write_practice_data()
+            self.session.close(status=status, **self.summary)
+            self.ledger.update(self.id, status=status)
 
         if self.eyelink:
             self.eyelink.save_data()
@@ -635,10 +713,13 @@ class Experiment(object):
 
     def emergency_save_data(self):
         logging.warning('emergency save data')
-        fp = f'{DATA_PATH}/{self.id}.txt'
-        with open(fp, 'w') as f:
-            f.write(str(self.all_data))
-        logging.info('wrote %s', fp)
+        if self.session.closed:
+            return  # save_data got far enough to record the status in both places
+        try:
+            self.write_practice_data()
+        finally:
+            self.session.close(status='emergency', **self.summary)
+            self.ledger.update(self.id, status='emergency')
 
 
 
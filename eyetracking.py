@@ -1,5 +1,4 @@
 import subprocess
-import pylink
 import os
 import random
 import time
@@ -9,8 +8,17 @@ from string import ascii_letters, digits
 import logging
 import numpy as np
 import hashlib
+import threading
+from collections import deque
+import queue
+import json
+from concurrent.futures import ThreadPoolExecutor
 
-from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy
+from util import jsonify
+from buffers import RingBuffer
+
+# pylink and EyeLinkCoreGraphicsPsychoPy are slow to import, so they are
+# imported where they are used, once the tracker is set up
 from psychopy import visual, core, event, monitors, gui
 
 def hide_dock():
@@ -51,6 +59,13 @@ def configure_data(tracker):
     tracker.sendCommand("calibration_type = HV9")
     tracker.sendCommand("enable_automatic_calibration = NO")
 
+def edf2asc(edf, asc):
+    try:
+        subprocess.run(["edf2asc", edf, asc])
+        return asc
+    except Exception as e:
+        logging.error('Error converting EDF to ASC: %s', e)
+
 def pix2height(win, pos):
     assert win.units == 'height'
     w, h = win.size / 2  # eyetracker uses non-retina pixels
@@ -63,6 +78,13 @@ def pix2height(win, pos):
     x /= h
     return x, y
 
+def pix2height_array(win, xy):
+    """Vectorized pix2height for an (n, 2) array of positions."""
+    assert win.units == 'height'
+    w, h = win.size / 2  # eyetracker uses non-retina pixels
+    xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+    return np.column_stack([(xy[:, 0] - w/2) / h, (h/2 - xy[:, 1]) / h])
+
 def height2pix(win, pos):
     assert win.units == 'height'
     w, h = win.size / 2  # eyetracker uses non-retina pixels
@@ -81,15 +103,33 @@ def height2pix(win, pos):
 
 class EyeLink(object):
     """Nice pylink interface"""
-    def __init__(self, win, uniqueid, dummy_mode=False):
+    def __init__(self, win, uniqueid, dummy_mode=False, async_messages=True, message_queue_size=1000):
         logging.info('New EyeLink object')
         self.win = win
         uniqueid = uniqueid.replace(':', '_')
         self.dummy_mode = dummy_mode
         self.uniqueid = uniqueid
         self.edf_file = ensure_edf_filename(uniqueid)
+        self.session_folder = os.path.join('data/eyelink', uniqueid)
         self.disable_drift_checks = False
-
+        # pylink isn't thread-safe: every tracker call after connect() holds this,
+        # including the EDF transfers on the transfer thread
+        self.link_lock = threading.Lock()
+        self.edf_part = 0
+        self.edf_transfers = []
+        self.transfer_pool = None
+        self.samples = RingBuffer(('time', 'x', 'y'))
+        self.link_events = []
+        self.read_lags = deque(maxlen=300)
+        self.message_queue = None
+        self.n_messages = 0
+        self.dropped_messages = 0
+        if async_messages:
+            self.start_message_thread(message_queue_size)
+        self.connect(dummy_mode)
+
+    def connect(self, dummy_mode=False):
+        import pylink
         if pylink.getEYELINK():
             logging.info('Using existing tracker')
             self.tracker = pylink.getEYELINK()
@@ -113,7 +153,8 @@ class EyeLink(object):
         self.win.units = 'height'
         x, y = map(int, height2pix(self.win, pos))
         try:
-            self.tracker.doDriftCorrect(x, y, 1, 1)
+            with self.link_lock:  # waits for any EDF transfer to finish
+                self.tracker.doDriftCorrect(x, y, 1, 1)
         except RuntimeError:
             logging.info('escape in drift correct')
             self.win.showMessage('Experimenter, choose:\n(C)ontinue  (A)bort  (R)ecalibrate  (D)isable drift check')
@@ -161,23 +202,91 @@ class EyeLink(object):
             return self.fake_drift_check(pos)
 
 
+    def start_message_thread(self, size):
+        """Send messages from a background thread so the frame loop never waits on the link."""
+        self.message_queue = queue.Queue(maxsize=size)
+        self.message_thread = threading.Thread(target=self._message_worker, name='eyelink-messages', daemon=True)
+        self.message_thread.start()
+
+    def _message_worker(self):
+        while True:
+            item = self.message_queue.get()
+            try:
+                if item is None:
+                    return
+                self._send_message(*item)
+            except Exception:
+                logging.exception('Error sending EyeLink message')
+            finally:
+                self.message_queue.task_done()
+
+    def _send_message(self, msg, t):
+        if not isinstance(msg, str):
+            msg = jsonify(msg)
+        # a leading integer tells the tracker the event happened that many ms before the message arrived
+        with self.link_lock:
+            offset = max(0, round(1000 * (core.getTime() - t)))
+            self.tracker.sendMessage(f'{offset} {msg}time({t})')
+        self.n_messages += 1
+
     def message(self, msg, log=True):
+        """Send msg (a string or anything jsonify can handle), timestamped now."""
         if log:
             logging.debug('EyeLink.message %s', msg)
-        self.tracker.sendMessage(msg + f'time({core.getTime()})')
+        t = core.getTime()
+        if self.message_queue is None:
+            self._send_message(msg, t)
+            return
+        try:
+            self.message_queue.put_nowait((msg, t))
+        except queue.Full:
+            self.dropped_messages += 1
+            if self.dropped_messages == 1 or self.dropped_messages % 100 == 0:
+                logging.warning('EyeLink message queue is full (%s messages dropped)', self.dropped_messages)
+
+    def flush_messages(self):
+        if self.message_queue is not None:
+            self.message_queue.join()
+
+    def stop_message_thread(self):
+        if self.message_queue is not None:
+            self.message_queue.put(None)
+            self.message_thread.join()
+            self.message_queue = None
+            logging.info('EyeLink sent %s messages, dropped %s', self.n_messages, self.dropped_messages)
 
     def start_recording(self):
+        import pylink
         logging.info('start_recording')
-        self.tracker.startRecording(1, 1, 1, 1)
+        with self.link_lock:  # wait for any EDF transfer to finish
+            self.tracker.startRecording(1, 1, 1, 1)
         pylink.pumpDelay(100)  # maybe necessary to clear out old samples??
 
     def stop_recording(self):
         logging.info('stop_recording')
-        self.tracker.stopRecording()
+        self.flush_messages()
+        with self.link_lock:
+            self.tracker.stopRecording()
 
     def setup_calibration(self, full_screen=False):
         # Open a window, be sure to specify monitor parameters
         self.message(f'Set up calibration')
+        self.send_screen_coords()
+
+        # Configure a graphics environment (genv) for tracker calibration
+        import pylink
+        from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy
+        self.genv = genv = EyeLinkCoreGraphicsPsychoPy(self.tracker, self.win)
+        foreground_color = (-1, -1, -1)
+        genv.setCalibrationColors(foreground_color, self.win.color)
+        genv.setTargetType('circle')
+        genv.setTargetSize(24)
+        # genv.setCalibrationSounds('', '', '')
+        genv.fixMacRetinaDisplay()
+        pylink.closeGraphics()
+        pylink.openGraphicsEx(genv)
+
+    def send_screen_coords(self):
         scn_width, scn_height = np.round(self.win.size / 2)  # / 2 for retina
         # pygame.mouse.set_visible(True)  # show mouse cursor
 
@@ -189,45 +298,92 @@ class EyeLink(object):
         w_trim = int((scn_width - scale * scn_height) / 2)
 
         el_coords = f"screen_pixel_coords = {w_trim} {h_trim} {scn_width - w_trim - 1} {scn_height - h_trim - 1}"
-        self.tracker.sendCommand(el_coords)
+        with self.link_lock:
+            self.tracker.sendCommand(el_coords)
         # For EyeLink Data Viewer
         # dv_coords = "DISPLAY_COORDS  0 0 %d %d" % (scn_width - 1, scn_height - 1)
         # self.tracker.sendMessage(dv_coords)
 
-        # Configure a graphics environment (genv) for tracker calibration
-        self.genv = genv = EyeLinkCoreGraphicsPsychoPy(self.tracker, self.win)
-        foreground_color = (-1, -1, -1)
-        genv.setCalibrationColors(foreground_color, self.win.color)
-        genv.setTargetType('circle')
-        genv.setTargetSize(24)
-        # genv.setCalibrationSounds('', '', '')
-        genv.fixMacRetinaDisplay()
-        pylink.closeGraphics()
-        pylink.openGraphicsEx(genv)
-
     def calibrate(self):
         self.win.mouseVisible = False
         self.genv.setup_cal_display()
         self.win.flip()
         logging.info('doTrackerSetup')
-        self.tracker.doTrackerSetup()
+        with self.link_lock:  # waits for any EDF transfer to finish
+            self.tracker.doTrackerSetup()
         logging.info('done doTrackerSetup')
         self.genv.exit_cal_display()
         self.win.flip()
         self.win.units = 'height'
         self.win.mouseVisible = True
 
+    def convert_edf(self, edf, asc):
+        return edf2asc(edf, asc)
+
+    def _transfer_part(self, host_file, part):
+        # runs on the transfer thread
+        os.makedirs(self.session_folder, exist_ok=True)
+        local_edf = os.path.join(self.session_folder, f'raw-{part}.edf')
+        logging.info('receiving eyelink data part %s', part)
+        with self.link_lock:
+            self.tracker.receiveDataFile(host_file, local_edf)
+        logging.info('wrote %s', local_edf)
+        asc_file = self.convert_edf(local_edf, os.path.join(self.session_folder, f'samples-{part}.asc'))
+        return {'part': part, 'host_file': host_file, 'edf': local_edf, 'asc': asc_file}
+
+    def rotate_data_file(self):
+        """Start a new EDF file, transferring and converting the finished one in the background.
+
+        The transfer holds the link, so the next drift check, calibration or
+        recording waits for it if it starts before the transfer is done.
+        """
+        self.flush_messages()
+        with self.link_lock:
+            self.tracker.setOfflineMode()
+            self.tracker.closeDataFile()
+            finished = self.edf_file
+            self.edf_file = ensure_edf_filename(f'{self.uniqueid}-{self.edf_part + 1}')
+            self.tracker.openDataFile(self.edf_file)
+        logging.info('rotated EDF file %s -> %s', finished, self.edf_file)
+
+        if self.transfer_pool is None:
+            self.transfer_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='edf-transfer')
+        self.edf_transfers.append(self.transfer_pool.submit(self._transfer_part, finished, self.edf_part))
+        self.edf_part += 1
+
+    def _merge_parts(self):
+        self.edf_transfers.append(self.transfer_pool.submit(self._transfer_part, self.edf_file, self.edf_part))
+        parts = []
+        for future in self.edf_transfers:
+            try:
+                parts.append(future.result())
+            except Exception:
+                logging.exception('Error transferring EDF part')
+        self.transfer_pool.shutdown()
+
+        asc_file = os.path.join(self.session_folder, 'samples.asc')
+        with open(asc_file, 'w') as out:
+            for p in parts:
+                if p['asc'] and os.path.isfile(p['asc']):
+                    with open(p['asc']) as f:
+                        out.writelines(f)
+        with open(os.path.join(self.session_folder, 'manifest.json'), 'w') as f:
+            json.dump({'parts': parts, 'asc': asc_file}, f, indent=2)
+        logging.info('merged %s EDF parts into %s', len(parts), asc_file)
+
     def save_data(self):
-        self.tracker.closeDataFile()
+        self.stop_message_thread()
+        with self.link_lock:
+            self.tracker.closeDataFile()
+        if self.edf_part > 0:
+            self._merge_parts()
+            with self.link_lock:
+                self.tracker.close()
+            return
 
         # Set up a folder to store the EDF data files and the associated resources
         # e.g., files defining the interest areas used in each trial
-        results_folder = 'data/eyelink'
-        if not os.path.exists(results_folder):
-            os.makedirs(results_folder)
-
-        # create a folder for the current testing session in the "results" folder
-        session_folder = os.path.join(results_folder, self.uniqueid)
+        session_folder = self.session_folder
         if not os.path.exists(session_folder):
             os.makedirs(session_folder)
 
@@ -235,27 +391,93 @@ class EyeLink(object):
         # parameters: source_file_on_the_host, destination_file_on_local_drive
         local_edf = os.path.join(session_folder,  'raw.edf')
         logging.info('receiving eyelink data')
-        self.tracker.receiveDataFile(self.edf_file, local_edf)
-        logging.info('wrote %s', local_edf)
-        self.tracker.close()
-        try:
-            asc_file = os.path.join(session_folder, 'samples.asc')
-            subprocess.run(["edf2asc", local_edf, asc_file])
-        except Exception as e:
-            logging.error('Error converting EDF to ASC: %s', e)
+        with self.link_lock:
+            self.tracker.receiveDataFile(self.edf_file, local_edf)
+            logging.info('wrote %s', local_edf)
+            self.tracker.close()
+        self.convert_edf(local_edf, os.path.join(session_folder, 'samples.asc'))
 
     def gaze_position(self):
-        sample = gaze = self.tracker.getNewestSample()
+        # never hold up a frame for the link; a busy link reads as missing gaze
+        if not self.link_lock.acquire(blocking=False):
+            return (-100000, -100000)
+        try:
+            sample = self.tracker.getNewestSample()
+        finally:
+            self.link_lock.release()
         if sample is None:
             return (-100000, -100000)
         else:
             eye = sample.getLeftEye() or sample.getRightEye()
             return pix2height(self.win, eye.getGaze())
 
+    def read_samples(self):
+        """Drains all samples and events queued on the link since the last call.
+
+        Returns an (n, 3) array of (time, x, y) gaze samples, with time in
+        seconds on the tracker clock and position in height units. Samples are
+        also added to self.samples. Fixation and saccade events are stored in
+        self.link_events as (kind, start time, end time, x, y). If another
+        thread is using the link, nothing is read; the data waits on the link
+        for the next call.
+        """
+        import pylink
+        event_kinds = {
+            pylink.STARTFIX: 'start fixation', pylink.ENDFIX: 'end fixation',
+            pylink.STARTSACC: 'start saccade', pylink.ENDSACC: 'end saccade',
+        }
+        times, xy = [], []
+        events = []
+        if not self.link_lock.acquire(blocking=False):
+            return np.empty((0, 3))
+        try:
+            while True:
+                kind = self.tracker.getNextData()
+                if not kind:
+                    break
+                data = self.tracker.getFloatData()
+                if kind == pylink.SAMPLE_TYPE:
+                    eye = data.getLeftEye() if data.isLeftSample() else data.getRightEye()
+                    if eye is None:
+                        continue
+                    x, y = eye.getGaze()
+                    if x == pylink.MISSING_DATA or y == pylink.MISSING_DATA:
+                        continue
+                    times.append(data.getTime())
+                    xy.append((x, y))
+                elif kind in event_kinds:
+                    end = data.getEndTime() if kind in (pylink.ENDFIX, pylink.ENDSACC) else None
+                    pos = data.getAverageGaze() if kind == pylink.ENDFIX else data.getStartGaze()
+                    events.append((event_kinds[kind], data.getStartTime(), end, *pos))
+        finally:
+            self.link_lock.release()
+
+        samples = np.empty((len(times), 3))
+        if times:
+            samples[:, 0] = np.array(times) / 1000
+            samples[:, 1:] = pix2height_array(self.win, xy)
+            self.samples.extend(samples)
+            self.read_lags.append(core.getTime() - samples[-1, 0])
+        for kind, start, end, x, y in events:
+            (x, y), = pix2height_array(self.win, (x, y))
+            self.link_events.append((kind, start / 1000, None if end is None else end / 1000, x, y))
+        return samples
+
+    def tracker_time(self, t):
+        """Local time t (core.getTime) on the tracker clock, in seconds, or None before any samples.
+
+        The offset between the clocks is the smallest lag between a sample's
+        time and when it was read, over the last few seconds of reads.
+        """
+        if not self.read_lags:
+            return None
+        return t - min(self.read_lags)
+
     def close_connection(self):
         # TODO make sure this gets called
-        if self.tracker.isConnected():
-            self.tracker.close()
+        with self.link_lock:
+            if self.tracker.isConnected():
+                self.tracker.close()
 
 class MouseLink(EyeLink):
     """Fake eyelink"""
@@ -263,9 +485,12 @@ class MouseLink(EyeLink):
         self.win = win
         self.mouse = event.Mouse()
         self.disable_drift_checks = False
+        self.samples = RingBuffer(('time', 'x', 'y'))
+        self.link_events = []
 
         print("UNITS", self.win.units)
 
+        from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy
         self.genv = genv = EyeLinkCoreGraphicsPsychoPy(None, self.win)
         foreground_color = (-1, -1, -1)
         genv.setCalibrationColors(foreground_color, self.win.color)
@@ -300,6 +525,10 @@ class MouseLink(EyeLink):
         logging.info('MouseLink calibrate')
         return
 
+    def rotate_data_file(self):
+        logging.info('MouseLink rotate_data_file')
+        return
+
     def save_data(self):
         logging.info('MouseLink save_data')
         return
@@ -307,6 +536,15 @@ class MouseLink(EyeLink):
     def gaze_position(self):
         return self.mouse.getPos()
 
+    def tracker_time(self, t):
+        return t
+
+    def read_samples(self):
+        x, y = self.mouse.getPos()
+        samples = np.array([[core.getTime(), x, y]])
+        self.samples.extend(samples)
+        return samples
+
     def close_connection(self):
         logging.info('MouseLink close_connection')
         return
@@ -0,0 +1,154 @@
+from collections import deque, namedtuple
+import numpy as np
+
+FixationEvent = namedtuple('FixationEvent', ['kind', 'time', 'x', 'y'])
+
+class RunningExtremes(object):
+    """Min and max over a sliding window, O(1) amortized per sample."""
+    def __init__(self):
+        self.lo = deque()  # (index, value), values increasing
+        self.hi = deque()  # (index, value), values decreasing
+
+    def push(self, i, v):
+        while self.lo and self.lo[-1][1] >= v:
+            self.lo.pop()
+        self.lo.append((i, v))
+        while self.hi and self.hi[-1][1] <= v:
+            self.hi.pop()
+        self.hi.append((i, v))
+
+    def expire(self, first):
+        # drop everything before index first
+        while self.lo and self.lo[0][0] < first:
+            self.lo.popleft()
+        while self.hi and self.hi[0][0] < first:
+            self.hi.popleft()
+
+    def range(self):
+        return self.hi[0][1] - self.lo[0][1]
+
+
+class FixationDetector(object):
+    """Base class for streaming fixation detectors.
+
+    update() takes an (n, 3) array of (time, x, y) samples and returns a list
+    of FixationEvents, 'start' and 'end', with the fixation centroid.
+    """
+    def __init__(self, min_duration=.06, max_gap=.1):
+        self.min_duration = min_duration
+        self.max_gap = max_gap
+        self.fixating = False
+        self.last_time = None
+        self._reset()
+
+    def _reset(self):
+        self.start_time = None
+        self.n = 0
+        self.sx = self.sy = 0.
+
+    @property
+    def centroid(self):
+        return self.sx / self.n, self.sy / self.n
+
+    def _end(self, t, events):
+        if self.fixating:
+            events.append(FixationEvent('end', t, *self.centroid))
+            self.fixating = False
+        self._reset()
+
+    def update(self, samples):
+        events = []
+        for t, x, y in samples:
+            if self.last_time is not None and t - self.last_time > self.max_gap:
+                self._end(self.last_time, events)
+            self._add(t, x, y, events)
+            self.last_time = t
+        return events
+
+
+class DispersionDetector(FixationDetector):
+    """I-DT: a fixation is a window of at least min_duration with (max x - min x) + (max y - min y) below dispersion."""
+    def __init__(self, dispersion=.03, **kws):
+        self.dispersion = dispersion
+        super().__init__(**kws)
+
+    def _reset(self):
+        super()._reset()
+        self.window = deque()  # (index, t, x, y)
+        self.xs = RunningExtremes()
+        self.ys = RunningExtremes()
+        self.i = 0
+
+    def _add(self, t, x, y, events):
+        self.i += 1
+        self.window.append((self.i, t, x, y))
+        self.xs.push(self.i, x)
+        self.ys.push(self.i, y)
+        self.n += 1
+        self.sx += x
+        self.sy += y
+
+        if self.xs.range() + self.ys.range() > self.dispersion:
+            if self.fixating:
+                self._end(self.window[-2][1], events)
+                self._add(t, x, y, events)
+                return
+            # slide the window start forward until it fits again
+            while self.xs.range() + self.ys.range() > self.dispersion:
+                _, _, x0, y0 = self.window.popleft()
+                self.n -= 1
+                self.sx -= x0
+                self.sy -= y0
+                first = self.window[0][0]
+                self.xs.expire(first)
+                self.ys.expire(first)
+
+        start = self.window[0][1]
+        if not self.fixating and t - start >= self.min_duration:
+            self.fixating = True
+            self.start_time = start
+            events.append(FixationEvent('start', t, *self.centroid))
+
+
+class VelocityDetector(FixationDetector):
+    """I-VT: a fixation is a run of at least min_duration where gaze speed stays below velocity.
+
+    Speed is measured against the sample about `window` seconds earlier, which
+    keeps tracker noise at high sampling rates from looking like movement.
+    """
+    def __init__(self, velocity=1., window=.02, **kws):
+        self.velocity = velocity
+        self.window = window
+        super().__init__(**kws)
+
+    def _reset(self):
+        super()._reset()
+        self.recent = deque()  # (t, x, y)
+
+    def _add(self, t, x, y, events):
+        recent = self.recent
+        while len(recent) > 1 and t - recent[1][0] >= self.window:
+            recent.popleft()
+        if recent:
+            pt, px, py = recent[0]
+            dt = t - pt
+            if dt > 0 and np.hypot(x - px, y - py) / max(dt, self.window) > self.velocity:
+                self._end(recent[-1][0], events)
+        if self.start_time is None:
+            self.start_time = t
+        self.recent.append((t, x, y))
+        self.n += 1
+        self.sx += x
+        self.sy += y
+        if not self.fixating and t - self.start_time >= self.min_duration:
+            self.fixating = True
+            events.append(FixationEvent('start', t, *self.centroid))
+
+
+DETECTORS = {
+    'idt': DispersionDetector,
+    'ivt': VelocityDetector,
+}
+
+def make_detector(kind, **kws):
+    return DETECTORS[kind](**kws)
@@ -0,0 +1,188 @@
+from collections import deque
+import time
+import numpy as np
+
+class GazeFilter(object):
+    """Base class for online gaze filters.
+
+    Calling the filter on an (n, 3) array of (time, x, y) samples returns the
+    filtered samples. predict(t) extrapolates the filtered position to time t
+    using the filter's velocity estimate. The time spent filtering is
+    accumulated so that stats() can report the cost per sample.
+    """
+    def __init__(self):
+        self.n_samples = 0
+        self.cost = 0.
+        self.last = None  # (t, x, y) of the last filtered sample
+        self.velocity = np.zeros(2)
+
+    def __call__(self, samples):
+        start = time.perf_counter()
+        out = np.empty_like(samples)
+        for k, (t, x, y) in enumerate(samples):
+            fx, fy = self._step(t, np.array([x, y]))
+            out[k] = t, fx, fy
+            self.last = out[k]
+        self.cost += time.perf_counter() - start
+        self.n_samples += len(samples)
+        return out
+
+    def predict(self, t):
+        if self.last is None:
+            return None
+        return self.last[1:] + self.velocity * (t - self.last[0])
+
+    def stats(self):
+        return {
+            'kind': self.__class__.__name__,
+            'n_samples': self.n_samples,
+            'us_per_sample': 1e6 * self.cost / max(self.n_samples, 1),
+        }
+
+
+class MedianFilter(GazeFilter):
+    """Median of the last n samples."""
+    def __init__(self, n=5):
+        super().__init__()
+        self.recent = deque(maxlen=n)
+
+    def _step(self, t, pos):
+        self.recent.append(pos)
+        out = np.median(self.recent, axis=0)
+        if self.last is not None and t > self.last[0]:
+            self.velocity = (out - self.last[1:]) / (t - self.last[0])
+        return out
+
+
+def _smoothing(dt, cutoff):
+    r = 2 * np.pi * cutoff * dt
+    return r / (r + 1)
+
+class OneEuroFilter(GazeFilter):
+    """1€ filter (Casiez et al. 2012): low-pass whose cutoff rises with speed."""
+    def __init__(self, min_cutoff=1., beta=10., d_cutoff=1.):
+        super().__init__()
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.pos = None
+
+    def _step(self, t, pos):
+        if self.pos is None or t <= self.last[0]:
+            self.pos = pos
+            return pos
+        dt = t - self.last[0]
+        a_d = _smoothing(dt, self.d_cutoff)
+        self.velocity = a_d * (pos - self.pos) / dt + (1 - a_d) * self.velocity
+        cutoff = self.min_cutoff + self.beta * np.linalg.norm(self.velocity)
+        a = _smoothing(dt, cutoff)
+        self.pos = a * pos + (1 - a) * self.pos
+        return self.pos
+
+
+class KalmanFilter(GazeFilter):
+    """Constant-velocity Kalman filter, independently on each axis."""
+    def __init__(self, process_noise=50., measurement_noise=.005):
+        super().__init__()
+        self.q = process_noise
+        self.r = measurement_noise ** 2
+        self.state = None  # (2 axes, [pos, vel])
+        self.P = None
+
+    def _step(self, t, pos):
+        if self.state is None:
+            self.state = np.column_stack([pos, np.zeros(2)])
+            self.P = np.tile(np.diag([self.r, 1.]), (2, 1, 1))
+            return pos
+        dt = max(t - self.last[0], 1e-6)
+        F = np.array([[1, dt], [0, 1]])
+        Q = self.q * np.array([[dt**3 / 3, dt**2 / 2], [dt**2 / 2, dt]])
+        self.state = self.state @ F.T
+        self.P = F @ self.P @ F.T + Q
+        # update with position measurement (H = [1, 0])
+        S = self.P[:, 0, 0] + self.r
+        K = self.P[:, :, 0] / S[:, None]
+        innovation = pos - self.state[:, 0]
+        self.state += K * innovation[:, None]
+        self.P -= K[:, :, None] * self.P[:, None, 0, :]
+        self.velocity = self.state[:, 1].copy()
+        return self.state[:, 0].copy()
+
+
+FILTERS = {
+    'median': MedianFilter,
+    'one_euro': OneEuroFilter,
+    'kalman': KalmanFilter,
+}
+
+def make_filter(kind, **kws):
+    return FILTERS[kind](**kws)
+
+
+def evaluate(samples, gaze_filter, horizon=0., max_lag=.05):
+    """Latency and jitter of a filter replayed over recorded samples.
+
+    Jitter is the RMS sample-to-sample movement during fixations (detected on
+    the raw data with I-DT). Latency is the shift of the raw signal that best
+    matches the filtered (and, with horizon > 0, extrapolated) signal.
+    """
+    from fixation import DispersionDetector
+
+    filtered = gaze_filter(samples)
+    if horizon:
+        pos = filtered[:, 1:].copy()
+        velocity = np.gradient(pos, filtered[:, 0], axis=0)
+        filtered[:, 1:] = pos + horizon * velocity
+
+    # samples within fixations
+    detector = DispersionDetector()
+    in_fix = np.zeros(len(samples), bool)
+    start = None
+    for k, row in enumerate(samples):
+        for e in detector.update(row[None]):
+            if e.kind == 'start':
+                start = k
+            else:
+                in_fix[start:k] = True
+                start = None
+
+    def jitter(x):
+        d = np.diff(x[:, 1:], axis=0)[in_fix[1:] & in_fix[:-1]]
+        return float(np.sqrt((d**2).sum(1).mean())) if len(d) else float('nan')
+
+    dt = np.median(np.diff(samples[:, 0]))
+    shifts = range(-round(max_lag / dt), round(max_lag / dt) + 1)
+    n = len(samples)
+    def error(s):
+        a, b = (filtered[s:, 1:], samples[:n - s, 1:]) if s >= 0 else (filtered[:n + s, 1:], samples[-s:, 1:])
+        return np.abs(a - b).mean()
+    lag = min(shifts, key=error)
+
+    return {
+        **gaze_filter.stats(),
+        'horizon_ms': 1000 * horizon,
+        'latency_ms': 1000 * lag * dt,
+        'jitter': jitter(filtered),
+        'raw_jitter': jitter(samples),
+    }
+
+
+def replay(asc_file, horizon=0., screen_height=1080, **kws):
+    """Prints latency/jitter for each filter replayed over a samples.asc file.
+
+    screen_height is the number of tracker pixels spanning the screen height,
+    used to convert positions to height units.
+    """
+    from asc import read_asc_samples
+    samples = read_asc_samples(asc_file)
+    samples[:, 1:] /= screen_height
+    print(f'{len(samples)} samples from {asc_file}')
+    for kind, cls in FILTERS.items():
+        result = evaluate(samples, cls(**kws.get(kind, {})), horizon)
+        print(f"{kind:10} {result['latency_ms']:6.1f} ms  jitter {result['jitter']:.3f} "
+              f"(raw {result['raw_jitter']:.3f})  {result['us_per_sample']:.1f} us/sample")
+
+
+if __name__ == '__main__':
+    from fire import Fire
+    Fire(replay)
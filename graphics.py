@@ -1,8 +1,43 @@
-from psychopy import core, visual, gui, data, event
+from psychopy import core, visual, gui, data, event, colors
 import numpy as np
+import os
+import json
+import logging
 wait = core.wait
 
-FRAME_RATE = 60
+FRAME_RATE = 60  # replaced by the measured rate in measure_frame_rate
+
+def measure_frame_rate(win, cache=None):
+    """Measures the refresh rate of win's display and sets FRAME_RATE.
+
+    Measurements are stored in the JSON file cache, keyed by screen and window
+    size, so each display is only probed once.
+    """
+    global FRAME_RATE
+    key = f'{win.screen}:{win.size[0]}x{win.size[1]}'
+    rates = {}
+    if cache and os.path.isfile(cache):
+        with open(cache) as f:
+            rates = json.load(f)
+    if key not in rates:
+        rate = win.getActualFrameRate(nIdentical=20, nMaxFrames=300, threshold=1)
+        if rate is None:
+            logging.warning('could not measure the frame rate, assuming %s Hz', FRAME_RATE)
+            return FRAME_RATE
+        rates[key] = round(rate, 2)
+        if cache:
+            with open(cache, 'w') as f:
+                json.dump(rates, f, indent=2)
+    FRAME_RATE = rates[key]
+    logging.info('frame rate %s Hz (%s)', FRAME_RATE, key)
+    return FRAME_RATE
+
+EASING = {
+    'linear': lambda p: p,
+    'in': lambda p: p * p,
+    'out': lambda p: 1 - (1 - p) ** 2,
+    'in_out': lambda p: p * p * (3 - 2 * p),
+}
 
 def move_towards(pos, dest, dist):
     total = np.linalg.norm(pos - dest)
@@ -23,6 +58,41 @@ def shift(obj, x, y):
     else:
         obj.setPos(obj.pos + np.array([x, y]))
 
+class StateChanges(object):
+    """Counts the stimulus changes made through update()."""
+    def __init__(self):
+        self.count = 0
+
+    def reset(self):
+        n, self.count = self.count, 0
+        return n
+
+STATE_CHANGES = StateChanges()
+
+def _same(a, b):
+    if isinstance(a, str) or isinstance(b, str):
+        return isinstance(a, str) and isinstance(b, str) and a == b
+    return np.array_equal(a, b)
+
+def update(obj, attr, value, force=False):
+    """Calls obj.attr(value), or sets obj.attr = value, unless value is what update last set it to.
+
+    Returns True if the stimulus was changed. Use force=True after the
+    attribute may have been changed some other way.
+    """
+    last = obj.__dict__.setdefault('_last_update', {})
+    if not force and attr in last and _same(last[attr], value):
+        return False
+    last[attr] = value
+    f = getattr(obj, attr)
+    if callable(f):
+        f(value)
+    else:
+        setattr(obj, attr, value)
+    STATE_CHANGES.count += 1
+    return True
+
+
 class MultiShape(object):
     """One shape composed of multiple visual objects."""
     def __init__(self, *objects):
@@ -40,11 +110,138 @@ class MultiShape(object):
         for o in self.objects:
             o.setOpacity(x)
 
+    def setDepth(self, x):
+        self.objects[0].setDepth(x)  # the first object determines the shape's depth
+
     def shift(self, x, y):
         for o in self.objects:
             shift(o, x, y)
 
 
+class Drawable(object):
+    """Base for composite objects that draw themselves on every flip, like a stimulus with autoDraw."""
+    depth = 0
+    _autoDraw = False
+
+    def draw(self):
+        raise NotImplementedError
+
+    # win.clearAutoDraw() assigns stim.autoDraw = False rather than calling setAutoDraw
+    @property
+    def autoDraw(self):
+        return self._autoDraw
+
+    @autoDraw.setter
+    def autoDraw(self, x):
+        self.setAutoDraw(x)
+
+    def setAutoDraw(self, x):
+        # mirrors BaseVisualStim.setAutoDraw: flip() draws everything in win._toDraw, ordered by depth
+        toDraw = self.win._toDraw
+        depths = getattr(self.win, '_toDrawDepths', None)
+        if x and self not in toDraw:
+            index = len(toDraw)
+            if depths is not None:
+                index = next((k for k, d in enumerate(depths) if d < self.depth), len(toDraw))
+                depths.insert(index, self.depth)
+            toDraw.insert(index, self)
+        elif not x and self in toDraw:
+            if depths is not None:
+                depths.pop(toDraw.index(self))
+            toDraw.remove(self)
+        self._autoDraw = x
+
+
+class CachedLabel(Drawable):
+    """A text label that keeps one TextStim per string it shows.
+
+    Changing a TextStim's text re-lays out the glyphs and rebuilds its
+    texture. Here each string is rendered once, and changing the text only
+    changes which stimulus is drawn. Height, color and opacity are applied
+    to a cached stimulus when it is next shown, and only if they differ.
+    """
+    def __init__(self, win, text='', pos=(0, 0), height=.03, color='black', strings=(), **kws):
+        self.win = win
+        self.pos = np.array(pos, dtype=float)
+        self.kws = kws
+        self.style = {'height': height, 'color': color, 'opacity': 1}
+        self.stims = {}
+        self.applied = {}
+        self.prerender(strings)
+        self._text = None
+        self.text = text
+
+    def prerender(self, strings):
+        for text in strings:
+            if text and text not in self.stims:
+                self.stims[text] = visual.TextStim(self.win, text, pos=self.pos, height=self.style['height'],
+                                                   color=self.style['color'], **self.kws)
+                self.applied[text] = dict(self.style)
+
+    def _apply(self):
+        if not self._text:
+            return
+        stim = self.stims[self._text]
+        applied = self.applied[self._text]
+        for k, v in self.style.items():
+            if applied[k] != v:
+                if k == 'height':
+                    stim.setHeight(v)
+                elif k == 'color':
+                    stim.color = v
+                else:
+                    stim.setOpacity(v)
+                applied[k] = v
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        if text != self._text:
+            self.prerender([text])
+            self._text = text
+            self._apply()
+
+    def setText(self, text):
+        self.text = text
+
+    @property
+    def height(self):
+        return self.style['height']
+
+    def setHeight(self, x):
+        self.style['height'] = x
+        self._apply()
+
+    @property
+    def color(self):
+        return self.style['color']
+
+    @color.setter
+    def color(self, x):
+        self.style['color'] = x
+        self._apply()
+
+    @property
+    def opacity(self):
+        return self.style['opacity']
+
+    def setOpacity(self, x):
+        self.style['opacity'] = x
+        self._apply()
+
+    def draw(self):
+        if self._text:
+            self.stims[self._text].draw()
+
+    def shift(self, x, y):
+        self.pos += [x, y]
+        for stim in self.stims.values():
+            stim.setPos(stim.pos + np.array([x, y]))
+
+
 def shape(f):
     def wrapper(self, *args, sub_shape=False, **kwargs):
         obj = f(self, *args, **kwargs)
@@ -80,6 +277,10 @@ class Graphics(object):
     def text(self, text, pos=(0,0), height=.03, color='black', **kws):
         return visual.TextStim(self.win, text, pos=pos, height=height, color=color, **kws)
 
+    @shape
+    def label(self, text, pos=(0,0), height=.03, color='black', strings=(), **kws):
+        return CachedLabel(self.win, text, pos=pos, height=height, color=color, strings=strings, **kws)
+
     @shape
     def arrow(self, c0, c1):
         line = self.line(c0.pos, c1.pos, depth=2, sub_shape=True)
@@ -93,13 +294,414 @@ class Graphics(object):
     def rect(self, pos, width, height, **kws):
         return visual.Rect(self.win, width, height, pos=pos, **kws)
 
-    def animate(self, sec):
+    def animate(self, sec, ease='linear'):
+        """Yields the eased progress (ending at 1) of a sec-second animation, once per frame.
+
+        Progress is measured from animation_start() to the time the next frame
+        should appear (last flip plus one refresh), so the animation lasts sec
+        seconds at any refresh rate and catches up after dropped frames. The
+        caller must flip after each step.
+        """
         self.animating = True
-        total = round(sec * FRAME_RATE)
-        for i in range(1,total+1):
-            yield i / total
+        ease = EASING.get(ease, ease)
+        interval = 1 / FRAME_RATE
+        start = t = animation_start(self.win)
+        while True:
+            t = max(self.win.lastFrameT, t) + interval
+            p = min((t - start) / sec, 1) if sec > 0 else 1
+            yield ease(p)
+            if p >= 1:
+                break
         self.animating = False
 
+    def tween(self, setter, start, end, sec, ease='linear'):
+        """Like animate, but also calls setter with the value eased from start to end."""
+        start, end = np.asarray(start, float), np.asarray(end, float)
+        for p in self.animate(sec, ease):
+            setter(start + p * (end - start))
+            yield p
+
     def shift(self, x=0, y=0):
         for o in self.objects:
             shift(o, x, y)
+
+
+def animation_start(win):
+    """The time an animation started now counts from.
+
+    That's the last flip, unless it was more than a frame ago because
+    something (like a wait) held up flipping; then it's now, so the time
+    spent not flipping isn't counted as part of the animation.
+    """
+    now = core.getTime()
+    if now - win.lastFrameT > 1 / FRAME_RATE:
+        return now
+    return win.lastFrameT
+
+
+class Tween(object):
+    def __init__(self, step, sec, ease, start, then):
+        self.step = step
+        self.sec = sec
+        self.ease = EASING.get(ease, ease)
+        self.start = start
+        self.then = then
+
+    def progress(self, t):
+        p = max(t - self.start, 0) / self.sec if self.sec > 0 else 1
+        return 1 if p > 1 - 1e-6 else p  # don't take an extra frame for rounding error
+
+
+class Animator(object):
+    """Runs any number of overlapping animations without blocking the trial loop.
+
+    start() registers an animation and returns immediately; step(), called once
+    per frame before the flip, advances every active animation with the same
+    flip-time progress as Graphics.animate. When an animation finishes, its
+    then() callback runs, which may start the next one. Starting an animation
+    with the key of one that is still running finishes the old one first.
+    """
+    def __init__(self, win):
+        self.win = win
+        self.active = {}
+        self.t = None  # time the next frame should appear
+
+    def __len__(self):
+        return len(self.active)
+
+    def __contains__(self, key):
+        return key in self.active
+
+    def start(self, step, sec, ease='linear', key=None, then=None):
+        if key is None:
+            key = object()
+        while key in self.active:
+            self.finish(key)
+        self.active[key] = Tween(step, sec, ease, animation_start(self.win), then)
+        return key
+
+    def tween(self, setter, start, end, sec, ease='linear', **kws):
+        """Calls setter with the value eased from start to end."""
+        start, end = np.asarray(start, float), np.asarray(end, float)
+        return self.start(lambda p: setter(start + p * (end - start)), sec, ease, **kws)
+
+    def after(self, sec, then, key=None):
+        """Calls then() sec seconds from the last flip."""
+        return self.start(None, sec, key=key, then=then)
+
+    def _end(self, key, tween):
+        if self.active.get(key) is tween:
+            del self.active[key]
+        if tween.then is not None:
+            tween.then()
+
+    def finish(self, key):
+        """Jumps an animation to its end."""
+        tween = self.active[key]
+        if tween.step is not None:
+            tween.step(tween.ease(1))
+        self._end(key, tween)
+
+    def finish_all(self):
+        while self.active:
+            self.finish(next(iter(self.active)))
+
+    def step(self):
+        if not self.active:
+            self.t = None
+            return
+        interval = 1 / FRAME_RATE
+        self.t = max(self.win.lastFrameT, self.t or 0) + interval
+        for key, tween in list(self.active.items()):
+            if self.active.get(key) is not tween:
+                continue  # replaced by a callback earlier in this frame
+            p = tween.progress(self.t)
+            if tween.step is not None:
+                tween.step(tween.ease(p))
+            if p >= 1:
+                self._end(key, tween)
+
+
+class Board(object):
+    """Stimuli for one layout and position, built once and reused across trials.
+
+    Arrows are built the first time each edge is needed. Only one trial
+    should use a board at a time; reset() restores the default appearance.
+    """
+    def __init__(self, win, layout, pos=(0, 0)):
+        self.win = win
+        self.layout = [tuple(xy) for xy in layout]
+        self.pos = tuple(pos)
+        self.gfx = gfx = Graphics(win)
+        self.nodes = [gfx.circle(0.7 * np.array([x, y]), name=f'node{i}', r=.04) for i, (x, y) in enumerate(layout)]
+        self.labels = [gfx.label('', n.pos, height=.04, name=f'lab{i}') for i, n in enumerate(self.nodes)]
+        self.timer_wrap = gfx.rect((0.5,-0.45), .02, 0.9, anchor='bottom', color=-.1)
+        self.timer = gfx.rect((0.5,-0.45), .02, 0.9, anchor='bottom', color=-.2)
+        self.mask = gfx.rect((.1,0), 1.1, 1, color='gray', opacity=0)
+        gfx.shift(*pos)
+        gfx.clear()
+        self.node_fill = self.nodes[0].fillColor
+        self.timer_line_width = self.timer.lineWidth
+        self.arrows = {}
+
+    def arrow(self, i, j):
+        if (i, j) not in self.arrows:
+            arrow = self.arrows[i, j] = self.gfx.arrow(self.nodes[i], self.nodes[j])
+            arrow.setAutoDraw(False)
+        return self.arrows[i, j]
+
+    @property
+    def objects(self):
+        """Objects drawn for the whole board, besides each trial's nodes, labels, and arrows."""
+        return []
+
+    def shift(self, x, y):
+        self.gfx.shift(x, y)
+        self.pos = (self.pos[0] + x, self.pos[1] + y)
+
+    def prerender(self, strings):
+        """Renders the given label strings for every node ahead of time."""
+        for lab in self.labels:
+            lab.prerender(strings)
+
+    def reset(self):
+        self.gfx.clear()
+        for n in self.nodes:
+            update(n, 'fillColor', self.node_fill, force=True)
+            update(n, 'setLineColor', 'black', force=True)
+        for lab in self.labels:
+            lab.text = ''
+            lab.color = 'black'
+            lab.setOpacity(1)
+            lab.setHeight(.04)
+        for arrow in self.arrows.values():
+            arrow.setAutoDraw(False)
+            update(arrow, 'setColor', 'black', force=True)
+            arrow.setOpacity(1)
+            update(arrow, 'setDepth', 2, force=True)
+        update(self.timer_wrap, 'setColor', -.1, force=True)
+        update(self.timer, 'setColor', -.2, force=True)
+        update(self.timer, 'setHeight', 0.9, force=True)
+        self.timer.setLineWidth(self.timer_line_width)
+        self.mask.setOpacity(0)
+
+
+_rgb_cache = {}
+def to_rgb(color):
+    key = color if isinstance(color, str) else tuple(np.atleast_1d(color))
+    if key not in _rgb_cache:
+        c = np.atleast_1d(color) if not isinstance(color, str) else None
+        _rgb_cache[key] = np.repeat(c, 3) if c is not None and len(c) == 1 else colors.Color(color).rgb
+    return _rgb_cache[key]
+
+def triangle_mask(res=64):
+    # texture rows run from bottom to top, so the tip (last row) points up
+    y, x = np.mgrid[0:res, 0:res] / (res - 1)
+    return np.where(np.abs(x - .5) <= .5 * (1 - y), 1., -1.)
+
+
+class NodeProxy(object):
+    """Stands in for a node Circle whose disc is drawn by a BoardRenderer."""
+    def __init__(self, renderer, i, pos, radius):
+        self.renderer = renderer
+        self.i = i
+        self.pos = np.array(pos, dtype=float)
+        self.radius = radius
+
+    @property
+    def fillColor(self):
+        return self.renderer.fill_colors[self.i]
+
+    @fillColor.setter
+    def fillColor(self, color):
+        self.renderer.set_node_color(self.i, fill=color)
+
+    def setLineColor(self, color):
+        self.renderer.set_node_color(self.i, line=color)
+
+    def setAutoDraw(self, x):
+        pass  # nodes are always drawn with the board
+
+    def shift(self, x, y):
+        self.pos += [x, y]
+
+
+class ArrowProxy(object):
+    """Stands in for an arrow MultiShape drawn by a BoardRenderer."""
+    def __init__(self, renderer, k):
+        self.renderer = renderer
+        self.k = k
+
+    def setColor(self, color):
+        self.renderer.set_edge(self.k, color=color)
+
+    def setOpacity(self, x):
+        self.renderer.set_edge(self.k, opacity=x)
+
+    def setDepth(self, x):
+        self.renderer.set_edge(self.k, depth=x)
+
+    def setAutoDraw(self, x):
+        self.renderer.set_edge(self.k, visible=x)
+
+    def shift(self, x, y):
+        pass  # shifted with the renderer
+
+
+class BoardRenderer(Drawable):
+    """Draws all edge lines, node discs and arrowheads with four ElementArrayStims.
+
+    Per-element colors, opacities and depths are kept in arrays and only
+    pushed to the GL buffers when they change.
+    """
+    def __init__(self, win, centers, radius=.04, line_width=10):
+        self.win = win
+        self.centers = np.array(centers, dtype=float)
+        self.radius = radius
+        n = len(self.centers)
+        lw = line_width / win.size[1]  # pixels to height units
+
+        self.edges = [(i, j) for i in range(n) for j in range(n) if i != j]
+        p0 = self.centers[[i for i, j in self.edges]]
+        p1 = self.centers[[j for i, j in self.edges]]
+        d = p1 - p0
+        length = np.linalg.norm(d, axis=1)
+        u = d / length[:, None]
+        ori = -np.degrees(np.arctan2(d[:, 1], d[:, 0]))
+        E = len(self.edges)
+
+        self.edge_color = np.tile(to_rgb('black'), (E, 1))
+        self.edge_opacity = np.ones(E)
+        self.edge_depth = np.full(E, 2.)
+        self.edge_visible = np.zeros(E, bool)
+        self.order = np.arange(E)
+
+        self.line_geometry = ((p0 + p1) / 2, np.column_stack([length, np.full(E, lw)]), ori)
+        tip = p1 - radius * u
+        self.head_geometry = (tip - .01 * u, np.full((E, 2), .02), ori + 90)
+
+        kws = dict(units='height', elementTex=None, colorSpace='rgb', autoLog=False)
+        self.lines = visual.ElementArrayStim(win, nElements=E, elementMask=None, **kws)
+        self.heads = visual.ElementArrayStim(win, nElements=E, elementMask=triangle_mask(), **kws)
+        self.borders = visual.ElementArrayStim(win, nElements=n, elementMask='circle', xys=self.centers,
+                                               sizes=2 * radius + lw, **kws)
+        self.discs = visual.ElementArrayStim(win, nElements=n, elementMask='circle', xys=self.centers,
+                                             sizes=2 * radius - lw, **kws)
+        self.fill_colors = ['white'] * n
+        self.line_colors = ['black'] * n
+        self.nodes_dirty = self.edges_dirty = self.order_dirty = True
+
+    def edge_index(self, i, j):
+        n = len(self.centers)
+        return i * (n - 1) + (j if j < i else j - 1)
+
+    def set_node_color(self, i, fill=None, line=None):
+        if fill is not None and fill != self.fill_colors[i]:
+            self.fill_colors[i] = fill
+            self.nodes_dirty = True
+        if line is not None and line != self.line_colors[i]:
+            self.line_colors[i] = line
+            self.nodes_dirty = True
+
+    def set_edge(self, k, color=None, opacity=None, depth=None, visible=None):
+        if color is not None:
+            rgb = to_rgb(color)
+            if not np.array_equal(rgb, self.edge_color[k]):
+                self.edge_color[k] = rgb
+                self.edges_dirty = True
+        if opacity is not None and opacity != self.edge_opacity[k]:
+            self.edge_opacity[k] = opacity
+            self.edges_dirty = True
+        if visible is not None and visible != self.edge_visible[k]:
+            self.edge_visible[k] = visible
+            self.edges_dirty = True
+        if depth is not None and depth != self.edge_depth[k]:
+            self.edge_depth[k] = depth
+            self.order_dirty = True
+
+    def shift(self, x, y):
+        self.centers += [x, y]
+        for xy, _, _ in (self.line_geometry, self.head_geometry):
+            xy += [x, y]
+        self.borders.xys = self.discs.xys = self.centers
+        self.order_dirty = True
+
+    def _update(self):
+        if self.order_dirty:
+            # higher depth is drawn first, i.e. further back
+            self.order = np.argsort(-self.edge_depth, kind='stable')
+            for stim, (xy, size, ori) in ((self.lines, self.line_geometry), (self.heads, self.head_geometry)):
+                stim.xys = xy[self.order]
+                stim.sizes = size[self.order]
+                stim.oris = ori[self.order]
+            self.edges_dirty = True
+        if self.edges_dirty:
+            opacity = (self.edge_opacity * self.edge_visible)[self.order]
+            for stim in (self.lines, self.heads):
+                stim.colors = self.edge_color[self.order]
+                stim.opacities = opacity
+        if self.nodes_dirty:
+            self.discs.colors = np.array([to_rgb(c) for c in self.fill_colors])
+            self.borders.colors = np.array([to_rgb(c) for c in self.line_colors])
+        self.order_dirty = self.edges_dirty = self.nodes_dirty = False
+
+    def draw(self):
+        self._update()
+        self.lines.draw()
+        self.borders.draw()
+        self.discs.draw()
+        self.heads.draw()
+
+
+
+class BatchedBoard(Board):
+    """A Board whose nodes and arrows are drawn by a single BoardRenderer."""
+    def __init__(self, win, layout, pos=(0, 0)):
+        self.win = win
+        self.layout = [tuple(xy) for xy in layout]
+        self.pos = tuple(pos)
+        self.gfx = gfx = Graphics(win)
+        centers = 0.7 * np.array(self.layout) + pos
+        self.renderer = BoardRenderer(win, centers)
+        gfx.objects.append(self.renderer)
+        self.nodes = [NodeProxy(self.renderer, i, c, self.renderer.radius) for i, c in enumerate(centers)]
+        self.labels = [gfx.label('', n.pos, height=.04, name=f'lab{i}') for i, n in enumerate(self.nodes)]
+        self.timer_wrap = gfx.rect((0.5 + pos[0], -0.45 + pos[1]), .02, 0.9, anchor='bottom', color=-.1)
+        self.timer = gfx.rect((0.5 + pos[0], -0.45 + pos[1]), .02, 0.9, anchor='bottom', color=-.2)
+        self.mask = gfx.rect((.1 + pos[0], pos[1]), 1.1, 1, color='gray', opacity=0)
+        gfx.clear()
+        self.node_fill = 'white'
+        self.timer_line_width = self.timer.lineWidth
+        self.arrows = {}
+
+    def arrow(self, i, j):
+        if (i, j) not in self.arrows:
+            self.arrows[i, j] = ArrowProxy(self.renderer, self.renderer.edge_index(i, j))
+        return self.arrows[i, j]
+
+    @property
+    def objects(self):
+        return [self.renderer]  # draws all nodes and arrows
+
+    def shift(self, x, y):
+        super().shift(x, y)
+        for n in self.nodes:
+            n.shift(x, y)
+
+
+class StimulusPool(object):
+    """Boards keyed by window, layout, position, and whether they are batched."""
+    def __init__(self):
+        self.boards = []
+
+    def get(self, win, layout, pos=(0, 0), batched=False):
+        layout = [tuple(xy) for xy in layout]
+        for b in self.boards:
+            if (b.win is win and b.layout == layout and np.allclose(b.pos, pos)
+                    and isinstance(b, BatchedBoard) == batched):
+                return b
+        b = (BatchedBoard if batched else Board)(win, layout, pos)
+        self.boards.append(b)
+        return b
+
+STIMULUS_POOL = StimulusPool()
@@ -0,0 +1,274 @@
+"""Stand-ins for the PsychoPy window, clock, input devices and stimuli.
+
+Trials run against these without a display or GPU. Stimuli only record the
+attributes set on them, flip() advances a virtual clock to the next refresh,
+and a Driver plays the participant by scripting clicks and gaze.
+
+    with headless() as (win, driver):
+        gt = GraphTrial(win, ..., eyelink=driver.link)
+        driver.attach(gt)
+        gt.run()
+"""
+from contextlib import contextmanager
+from types import SimpleNamespace
+import numpy as np
+
+import graphics
+import trial
+
+
+class VirtualClock(object):
+    """Replaces psychopy.core: time only passes on flips and waits."""
+    def __init__(self, t=0.):
+        self.t = t
+
+    def getTime(self):
+        return self.t
+
+    def wait(self, secs, hogCPUperiod=0):
+        self.t += secs
+
+
+class Stim(object):
+    """Any visual stimulus. setFoo(x) sets foo = x; draw() does nothing."""
+    args = ()
+    defaults = dict(pos=(0, 0), fillColor='white', lineColor='black', lineWidth=1.5,
+                    color='white', opacity=1, ori=0, depth=0)
+
+    def __init__(self, win, *args, **kws):
+        self.win = win
+        self.__dict__.update(self.defaults)
+        self.__dict__.update(zip(self.args, args))
+        self.__dict__.update(kws)
+        self.pos = np.array(self.pos, dtype=float)
+        self._autoDraw = False
+
+    def __getattr__(self, name):
+        if name.startswith('set') and len(name) > 3:
+            attr = name[3].lower() + name[4:]
+            def setter(value, *args, **kws):
+                setattr(self, attr, value)
+            return setter
+        raise AttributeError(name)
+
+    def setPos(self, pos, *args, **kws):
+        self.pos = np.array(pos, dtype=float)
+
+    @property
+    def autoDraw(self):
+        return self._autoDraw
+
+    @autoDraw.setter
+    def autoDraw(self, x):
+        self.setAutoDraw(x)
+
+    def setAutoDraw(self, x, log=None):
+        if x and self not in self.win._toDraw:
+            self.win._toDraw.append(self)
+        elif not x and self in self.win._toDraw:
+            self.win._toDraw.remove(self)
+        self._autoDraw = x
+
+    def draw(self, win=None):
+        pass
+
+
+class TextStim(Stim):
+    args = ('text',)
+
+class Rect(Stim):
+    args = ('width', 'height')
+
+visual = SimpleNamespace(
+    Circle=Stim, ShapeStim=Stim, ElementArrayStim=Stim, TextStim=TextStim, Rect=Rect,
+    line=SimpleNamespace(Line=Stim),
+)
+
+
+class Window(object):
+    """Flips instantly, as if every frame made its vsync.
+
+    If schedule is set to an array of flip times, flips land on those times
+    instead, falling back to vsyncs after the last one.
+    """
+    def __init__(self, clock, size=(1350, 750), frame_rate=60):
+        self.clock = clock
+        self.size = np.array(size)
+        self.units = 'height'
+        self.screen = 0
+        self.color = np.zeros(3)
+        self.mouseVisible = True
+        self.frame_interval = 1 / frame_rate
+        self.lastFrameT = clock.getTime()
+        self.n_flips = 0
+        self.schedule = None
+        self._toDraw = []
+        self._callbacks = []
+
+    def flip(self, clearBuffer=True):
+        for stim in list(self._toDraw):
+            stim.draw()
+        t = self.clock.t = self.next_flip(self.clock.t)
+        self.lastFrameT = t
+        self.n_flips += 1
+        for f in self._callbacks:
+            f(t)
+        return t
+
+    def next_flip(self, t):
+        if self.schedule is not None:
+            i = np.searchsorted(self.schedule, t, side='right')
+            if i < len(self.schedule):
+                return self.schedule[i]
+        # the epsilon keeps rounding error from landing on the current vsync
+        return (np.floor(t / self.frame_interval + 1e-6) + 1) * self.frame_interval
+
+    def callOnFlip(self, f):
+        self._callbacks.append(f)
+
+    def clearAutoDraw(self):
+        # as in PsychoPy, by assignment
+        for stim in list(self._toDraw):
+            stim.autoDraw = False
+
+    def getActualFrameRate(self, **kws):
+        return 1 / self.frame_interval
+
+
+class Mouse(object):
+    def __init__(self):
+        self.pos = np.zeros(2)
+        self.pressed = [0, 0, 0]
+
+    def getPos(self):
+        return self.pos.copy()
+
+    def getPressed(self):
+        return list(self.pressed)
+
+
+class Events(object):
+    """Replaces psychopy.event: one shared mouse and a queue of key presses."""
+    def __init__(self):
+        self.mouse = Mouse()
+        self.keys = []
+
+    def Mouse(self, *args, **kws):
+        return self.mouse
+
+    def getKeys(self, keyList=None, **kws):
+        keys = [k for k in self.keys if keyList is None or k in keyList]
+        self.keys = [k for k in self.keys if k not in keys]
+        return keys
+
+    def waitKeys(self, keyList=None, **kws):
+        return keyList[:1] if keyList else ['space']
+
+
+class HeadlessLink(object):
+    """Replaces EyeLink: gaze dwells on one of the targets at a time, with noise."""
+    def __init__(self, clock, rate=1000, noise=.003, dwell=.25, seed=0):
+        self.clock = clock
+        self.rate = rate
+        self.noise = noise
+        self.dwell = dwell
+        self.rng = np.random.default_rng(seed)
+        self.targets = [(0, 0)]
+        self.target = np.zeros(2)
+        self.next_target = 0.
+        self.last_sample = clock.getTime()
+        self.n_messages = 0
+
+    def read_samples(self):
+        t = np.arange(self.last_sample, self.clock.getTime(), 1 / self.rate)[1:]
+        if not len(t):
+            return np.empty((0, 3))
+        self.last_sample = t[-1]
+        if t[-1] >= self.next_target:
+            self.target = np.array(self.targets[self.rng.integers(len(self.targets))], dtype=float)
+            self.next_target = t[-1] + self.dwell
+        xy = self.target + self.noise * self.rng.standard_normal((len(t), 2))
+        return np.column_stack([t, xy])
+
+    def tracker_time(self, t):
+        return t
+
+    def message(self, msg, log=True):
+        self.n_messages += 1
+
+    def drift_check(self, pos=(0, 0)):
+        return 'ok'
+
+    fake_drift_check = drift_check
+
+    def start_recording(self):
+        pass
+
+    def stop_recording(self):
+        pass
+
+
+class Driver(object):
+    """Plays the participant for one trial at a time.
+
+    Planning ends with a click on the start node after plan_time seconds, then
+    a random child is clicked every step_time seconds. Gaze wanders between
+    the nodes, except in a CalibrationTrial, where it goes to the target.
+    """
+    def __init__(self, win, events, plan_time=1., step_time=.4, seed=0):
+        self.win = win
+        self.mouse = events.mouse
+        self.link = HeadlessLink(win.clock, seed=seed)
+        self.plan_time = plan_time
+        self.step_time = step_time
+        self.rng = np.random.default_rng(seed)
+        self.trial = None
+        win.callOnFlip(self.on_flip)
+
+    def attach(self, trial):
+        self.trial = trial
+        self.next_action = self.win.clock.getTime() + self.plan_time
+
+    def click(self, i):
+        self.mouse.pos = self.trial.click_index.centers[i].copy()
+        self.mouse.pressed = [1, 0, 0]
+
+    def on_flip(self, t):
+        self.mouse.pressed = [0, 0, 0]
+        gt = self.trial
+        if gt is None or not hasattr(gt, 'click_index'):
+            return
+        centers = gt.gaze_index.centers
+        if isinstance(gt, trial.CalibrationTrial):
+            if gt.target is not None and not np.array_equal(self.link.targets, centers[[gt.target]]):
+                self.link.targets = centers[[gt.target]]
+                self.link.next_target = t + .2  # saccade latency
+            return
+        self.link.targets = centers
+        if t < self.next_action or gt.current_state is None:
+            return
+        if gt.stage == 'planning':
+            self.click(gt.current_state)
+        elif gt.graph[gt.current_state]:
+            self.click(self.rng.choice(gt.graph[gt.current_state]))
+        self.next_action = t + self.step_time
+
+
+@contextmanager
+def headless(frame_rate=60, size=(1350, 750), driver=Driver, **kws):
+    """Swaps the stand-ins into trial and graphics; yields the window and a driver(win, events, **kws)."""
+    clock = VirtualClock()
+    events = Events()
+    win = Window(clock, size, frame_rate)
+    driver = driver(win, events, **kws)
+    patches = [(trial, 'core', clock), (trial, 'event', events), (trial, 'visual', visual),
+               (graphics, 'core', clock), (graphics, 'visual', visual), (graphics, 'FRAME_RATE', frame_rate)]
+    saved = [(module, name, getattr(module, name)) for module, name, _ in patches]
+    for module, name, value in patches:
+        setattr(module, name, value)
+    try:
+        yield win, driver
+    finally:
+        for module, name, value in saved:
+            setattr(module, name, value)
+        graphics.STIMULUS_POOL.boards = [b for b in graphics.STIMULUS_POOL.boards if b.win is not win]
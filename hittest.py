@@ -0,0 +1,74 @@
+from collections import defaultdict
+import numpy as np
+
+class NodeIndex(object):
+    """Finds the node (if any) containing a point.
+
+    Node centers and radii are stored as arrays so that a lookup is a single
+    vectorized distance computation. For large boards, candidates are first
+    narrowed down with a uniform grid.
+    """
+    def __init__(self, centers, radii, grid_threshold=64):
+        self.centers = np.array(centers, dtype=float).reshape(-1, 2)
+        self.radii = np.broadcast_to(np.asarray(radii, dtype=float), len(self.centers)).copy()
+        self.r2 = self.radii ** 2
+        self.use_grid = len(self.centers) > grid_threshold
+        if self.use_grid:
+            self._build_grid()
+
+    def __len__(self):
+        return len(self.centers)
+
+    def _build_grid(self):
+        self.cell_size = 2 * self.radii.max()
+        cells = defaultdict(list)
+        lo = np.floor((self.centers - self.radii[:, None]) / self.cell_size).astype(int)
+        hi = np.floor((self.centers + self.radii[:, None]) / self.cell_size).astype(int)
+        for i in range(len(self.centers)):
+            for cx in range(lo[i, 0], hi[i, 0] + 1):
+                for cy in range(lo[i, 1], hi[i, 1] + 1):
+                    cells[cx, cy].append(i)
+        self.cells = {k: np.array(v) for k, v in cells.items()}
+
+    def _nearest(self, points, idx):
+        # points: (n, 2), idx: candidate node indices. returns node index or -1 for each point
+        d2 = ((points[:, None, :] - self.centers[idx][None, :, :]) ** 2).sum(axis=2)
+        rel = d2 / self.r2[idx]
+        best = rel.argmin(axis=1)
+        hit = rel[np.arange(len(points)), best] < 1
+        return np.where(hit, idx[best], -1)
+
+    def find(self, pos):
+        """Index of the node containing pos, or None."""
+        point = np.asarray(pos, dtype=float).reshape(1, 2)
+        if self.use_grid:
+            idx = self.cells.get(tuple(np.floor(point[0] / self.cell_size).astype(int)))
+            if idx is None:
+                return None
+        else:
+            idx = np.arange(len(self.centers))
+        i = self._nearest(point, idx)[0]
+        return None if i == -1 else int(i)
+
+    def find_all(self, points):
+        """Node index for each row of points (-1 if no node contains it)."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if len(points) == 0 or len(self.centers) == 0:
+            return np.full(len(points), -1)
+        if not self.use_grid:
+            return self._nearest(points, np.arange(len(self.centers)))
+
+        result = np.full(len(points), -1)
+        cells = np.floor(points / self.cell_size).astype(int)
+        keys, inverse = np.unique(cells, axis=0, return_inverse=True)
+        for k, key in enumerate(keys):
+            idx = self.cells.get(tuple(key))
+            if idx is not None:
+                mask = inverse.ravel() == k
+                result[mask] = self._nearest(points[mask], idx)
+        return result
+
+    def shift(self, x, y):
+        self.centers += [x, y]
+        if self.use_grid:
+            self._build_grid()
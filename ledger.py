@@ -0,0 +1,210 @@
+"""A record of every session and the config it holds.
+
+The ledger is an SQLite file, so the lookups the experiment and
+process_data need are indexed queries rather than directory listings.
+Claiming a config happens in one write transaction, which only keeps rigs
+apart if they open the same file on storage with working file locks (a
+local disk, or a network share that supports them). Don't put it in a
+folder a sync service copies between rigs: the service ignores SQLite's
+locks, so two rigs can claim the same config, and a copy made in the
+middle of a transaction can corrupt the file. Set LEDGER_PATH in the
+environment to move it.
+
+    python ledger.py list e4 --status complete
+    python ledger.py release 24-01-01-1200_P3    # make P3's config available again
+"""
+import os
+import re
+import time
+import socket
+import sqlite3
+import logging
+from contextlib import contextmanager
+
+LEDGER_PATH = os.environ.get('LEDGER_PATH', 'data/ledger.sqlite')
+
+# sessions with these statuses give up their config
+RELEASED = ('abandoned',)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS configs (
+    version TEXT NOT NULL,
+    config_number INTEGER NOT NULL,
+    PRIMARY KEY (version, config_number)
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    config_number INTEGER NOT NULL,
+    holds INTEGER NOT NULL DEFAULT 1,  -- whether the config is used up, e.g. not for test sessions
+    status TEXT NOT NULL,
+    rig TEXT,
+    data_path TEXT,
+    eyelink_path TEXT,
+    log_path TEXT,
+    started REAL,
+    finished REAL,
+    processed REAL
+);
+CREATE INDEX IF NOT EXISTS sessions_config ON sessions (version, config_number, holds, status);
+CREATE INDEX IF NOT EXISTS sessions_status ON sessions (version, status);
+CREATE TABLE IF NOT EXISTS backfilled (
+    version TEXT PRIMARY KEY,
+    time REAL
+);
+'''
+FIELDS = ('holds', 'status', 'rig', 'data_path', 'eyelink_path', 'log_path', 'started', 'finished', 'processed')
+
+
+class Ledger(object):
+    def __init__(self, path=LEDGER_PATH, timeout=30):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        # autocommit; transactions are opened explicitly
+        self.db = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    @contextmanager
+    def transaction(self):
+        """Holds the write lock, so nothing read inside can change before it commits."""
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.db
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def register_configs(self, version, numbers):
+        with self.transaction() as db:
+            db.executemany('INSERT OR IGNORE INTO configs VALUES (?, ?)', [(version, int(n)) for n in numbers])
+
+    def next_free(self, version):
+        """The lowest config no session holds, or else the least used one."""
+        row = self.db.execute(f'''
+            SELECT c.config_number, (
+                SELECT count(*) FROM sessions s
+                WHERE s.version = c.version AND s.config_number = c.config_number AND s.holds
+                AND s.status NOT IN ({",".join("?" * len(RELEASED))})
+            ) AS n
+            FROM configs c WHERE c.version = ?
+            ORDER BY n, c.config_number LIMIT 1
+        ''', (*RELEASED, version)).fetchone()
+        if row is None:
+            raise LookupError(f'no configs registered for {version}')
+        if row['n']:
+            logging.warning('every config for %s is taken; reusing config %s (%s sessions)',
+                            version, row['config_number'], row['n'])
+        return row['config_number']
+
+    def claim(self, version, make_id, config_number=None, **fields):
+        """Records a new running session and returns (id, config_number).
+
+        The next free config is used unless config_number is given.
+        make_id(config_number) gives the session id.
+        """
+        with self.transaction() as db:
+            if config_number is None:
+                config_number = self.next_free(version)
+            session_id = make_id(config_number)
+            fields = {'rig': socket.gethostname(), 'started': time.time(), **fields, 'status': 'running'}
+            db.execute(f'INSERT INTO sessions (id, version, config_number, {", ".join(fields)}) '
+                       f'VALUES (?, ?, ?, {", ".join("?" * len(fields))})',
+                       (session_id, version, int(config_number), *fields.values()))
+        return session_id, config_number
+
+    def update(self, session_id, **fields):
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError(f'unknown ledger fields {unknown}')
+        if fields.get('status') in ('complete', 'emergency') and 'finished' not in fields:
+            fields['finished'] = time.time()
+        with self.transaction() as db:
+            db.execute(f'UPDATE sessions SET {", ".join(f"{k} = ?" for k in fields)} WHERE id = ?',
+                       (*fields.values(), session_id))
+
+    def release(self, session_id):
+        """Frees the config held by a session that won't be used, e.g. a false start."""
+        self.update(session_id, status='abandoned')
+
+    def sessions(self, version, status=None):
+        """Sessions as dicts, oldest first, optionally only those with the given status(es)."""
+        query = 'SELECT * FROM sessions WHERE version = ?'
+        args = [version]
+        if status is not None:
+            status = (status,) if isinstance(status, str) else tuple(status)
+            query += f' AND status IN ({",".join("?" * len(status))})'
+            args += status
+        return [dict(row) for row in self.db.execute(query + ' ORDER BY started, id', args)]
+
+    def backfill(self, version, data_path, eyelink_path='data/eyelink', force=False):
+        """Adds the sessions in data_path that predate the ledger. Runs once per version unless force."""
+        with self.transaction() as db:
+            if not force and db.execute('SELECT 1 FROM backfilled WHERE version = ?', (version,)).fetchone():
+                return 0
+            known = {row[0] for row in db.execute('SELECT id FROM sessions WHERE version = ?', (version,))}
+
+        rows = []
+        for fn in sorted(os.listdir(data_path)) if os.path.isdir(data_path) else []:
+            if os.path.splitext(fn)[0] in known:
+                continue
+            row = session_row(version, f'{data_path}/{fn}', eyelink_path)
+            if row is not None:
+                rows.append(row)
+        with self.transaction() as db:
+            db.executemany('INSERT OR IGNORE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            db.execute('INSERT OR REPLACE INTO backfilled VALUES (?, ?)', (version, time.time()))
+        logging.info('backfilled %s sessions for %s from %s', len(rows), version, data_path)
+        return len(rows)
+
+    def add_session(self, version, path, eyelink_path='data/eyelink'):
+        """Adds the session in data file path, e.g. one another rig ran, unless it is already known.
+
+        A released session with the same id (another rig's started in the
+        same minute with the same config) is replaced.
+        """
+        row = session_row(version, path, eyelink_path)
+        if row is None:
+            raise ValueError(f'{path} is not a session file')
+        with self.transaction() as db:
+            db.execute(f'DELETE FROM sessions WHERE id = ? AND status IN ({",".join("?" * len(RELEASED))})',
+                       (row[0], *RELEASED))
+            db.execute('INSERT OR IGNORE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+
+
+def session_row(version, path, eyelink_path='data/eyelink'):
+    """A sessions row for the data file at path, or None if it isn't a session file."""
+    from session import load_session
+    sid, ext = os.path.splitext(os.path.basename(path))
+    m = re.match(r'.*_P(\d+)(-.*)?$', sid)
+    if not m or ext not in ('.json', '.jsonl', '.h5'):
+        return None
+    if ext == '.json':
+        status = 'complete'  # written in one go at the end
+    else:
+        try:
+            status = 'complete' if load_session(path)['complete'] else 'incomplete'
+        except Exception:
+            logging.exception('could not read %s', path)
+            status = 'incomplete'
+    # named sessions (e.g. tests) never took up their config
+    return (sid, version, int(m.group(1)), m.group(2) is None, status, None, path, f'{eyelink_path}/{sid}',
+            None, os.path.getmtime(path), None, None)
+
+
+def list_sessions(version, status=None, path=LEDGER_PATH):
+    for s in Ledger(path).sessions(version, status):
+        started = time.strftime('%Y-%m-%d %H:%M', time.localtime(s['started'])) if s['started'] else '?'
+        print(f"{s['id']:30} P{s['config_number']:<4} {s['status']:10} {s['rig'] or '':16} {started}")
+
+def release(session_id, path=LEDGER_PATH):
+    Ledger(path).release(session_id)
+
+
+if __name__ == '__main__':
+    from fire import Fire
+    Fire({'list': list_sessions, 'release': release})
@@ -1,31 +1,42 @@
+import time
+LAUNCH = time.perf_counter()
 from experiment import Experiment
+IMPORTED = time.perf_counter()
 from fire import Fire
 import logging
 
-def main(config_number=None, name=None, test=False, fast=False, full=False, mouse=False, block=None, initial_score=None, skip_intro=False, **kws):
+def main(config_number=None, name=None, test=False, fast=False, full=False, mouse=False, sim=False, block=None, initial_score=None, skip_intro=False, profile_startup=False, schedule=False, **kws):
     if test and name is None:
         name = 'test'
     if fast:
         kws['score_limit'] = 10
+    if profile_startup:
+        from util import import_times
+        print('import time by package (fresh interpreter):')
+        for package, sec in import_times('experiment'):
+            print(f'  {package:20} {sec:6.3f}s')
     exp = Experiment(config_number, name, full_screen=(not test) or full, **kws)
+    if profile_startup:
+        logging.info('startup: imports took %.2fs, Experiment() %.2fs', IMPORTED - LAUNCH, time.perf_counter() - IMPORTED)
+        exp.win.callOnFlip(lambda: logging.info('startup: first screen %.2fs after launch', time.perf_counter() - LAUNCH))
     if test:
         if test == 'survey':
             exp.save_data(survey=True)
         elif test == 'main':
-            exp.run_main()
+            exp.run_main(schedule=schedule)
         else:
             if not skip_intro:
                 exp.intro()
                 exp.practice_start()
                 exp.practice(2)
                 # exp.practice_timelimit()
-            exp.setup_eyetracker(mouse)
+            exp.setup_eyetracker(mouse, sim)
             exp.show_gaze_demo()
             exp.intro_gaze()
             exp.calibrate_gaze_tolerance()
             # exp.intro_contingent()
             exp.intro_main()
-            exp.run_main()
+            exp.run_main(schedule=schedule)
             # exp.do_survey()
             # exp.save_data()
         return
@@ -35,13 +46,13 @@ def main(config_number=None, name=None, test=False, fast=False, full=False, mous
                 exp.intro()
                 exp.practice_start()
                 exp.practice(1)
-                exp.setup_eyetracker(mouse)
+                exp.setup_eyetracker(mouse, sim)
                 exp.show_gaze_demo()
                 exp.intro_gaze()
                 exp.calibrate_gaze_tolerance()
                 # exp.intro_contingent()
                 exp.intro_main()
-                exp.run_main()
+                exp.run_main(schedule=schedule)
                 # exp.do_survey()
             elif block:
                 if initial_score:
@@ -59,10 +70,11 @@ def main(config_number=None, name=None, test=False, fast=False, full=False, mous
                     'run_main',
                 ]
                 # Start Generation Here
+                kws = {'setup_eyetracker': dict(mouse=mouse, sim=sim), 'run_main': dict(schedule=schedule)}
                 try:
                     start = blocks.index(block)
                     for b in blocks[start:]:
-                        getattr(exp, b)()
+                        getattr(exp, b)(**kws.get(b, {}))
                 except ValueError:
                     logging.error(f"Block '{block}' not found in blocks list.")
 
@@ -70,13 +82,13 @@ def main(config_number=None, name=None, test=False, fast=False, full=False, mous
                 exp.intro()
                 exp.practice_start()
                 exp.practice(2)
-                exp.setup_eyetracker(mouse)
+                exp.setup_eyetracker(mouse, sim)
                 exp.show_gaze_demo()
                 exp.intro_gaze()
                 exp.calibrate_gaze_tolerance()
                 # exp.intro_contingent()
                 exp.intro_main()
-                exp.run_main()
+                exp.run_main(schedule=schedule)
 
             exp.save_data(survey=False)
         except:
@@ -87,12 +99,11 @@ def main(config_number=None, name=None, test=False, fast=False, full=False, mous
             exp.win.showMessage("Drat! The experiment has encountered an error.\nPlease inform the experimenter.")
             exp.win.flip()
             try:
-                exp.save_data()
-                raise
+                exp.save_data(status='emergency')
             except:
                 logging.exception('error on second save data attempt')
                 exp.emergency_save_data()
-                raise
+            raise
 
 
 if __name__ == '__main__':
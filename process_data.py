@@ -2,41 +2,64 @@ import os
 import sys
 import json
 import pandas as pd
+import time
 import subprocess
 
+from session import load_session
+from ledger import Ledger
+from solver import annotate
+
 from config import VERSION
 # wid = 'fred'
 if len(sys.argv) > 1:
     VERSION = sys.argv[1]
 
 
+ledger = Ledger()
+ledger.backfill(VERSION, f"data/exp/{VERSION}")
+
 trials = []
-for file in sorted(os.listdir(f"data/exp/{VERSION}/")):
-    if 'test' in file or 'txt' in file:
+for session in ledger.sessions(VERSION):
+    wid = session['id']
+    if 'test' in wid or session['status'] == 'abandoned' or not session['data_path']:
         continue
-    wid = file.replace('.json', '')
     # wid = uid.rsplit('-', 1)[1]
 
     # experimental data
-    fn = f"data/exp/{VERSION}/{file}"
+    fn = session['data_path']
     print(fn)
-    with open(fn) as f:
-        data = json.load(f)
+    if fn.endswith('.jsonl') or fn.endswith('.h5'):
+        data = load_session(fn)
+        if session['status'] != 'complete':
+            print(f'WARNING: {fn} is {session["status"]}')
+    else:
+        with open(fn) as f:
+            data = json.load(f)
     for i, t in enumerate(data["trial_data"]):
         t["wid"] = wid
         t["trial_index"] = i
         trials.append(t)
 
     # eyelink data
-    edf = f'data/eyelink/{wid}/raw.edf'
-    assert os.path.isfile(edf)
-    dest = f'data/eyelink/{wid}/samples.asc'
-    if os.path.isfile(edf) and not os.path.isfile(dest):
-        cmd = f'edf2asc {edf} {dest}'
-        output = subprocess.getoutput(cmd)
-        if 'Converted successfully' not in output:
-            print(f'Error parsing {edf}', '-'*80, output, '-'*80, sep='\n')
+    if session['processed']:
+        continue
+    eyelink = session['eyelink_path'] or f'data/eyelink/{wid}'
+    if not os.path.isfile(f'{eyelink}/manifest.json'):  # rotated EDF parts were converted during the session
+        edf = f'{eyelink}/raw.edf'
+        assert os.path.isfile(edf)
+        dest = f'{eyelink}/samples.asc'
+        if os.path.isfile(edf) and not os.path.isfile(dest):
+            cmd = f'edf2asc {edf} {dest}'
+            output = subprocess.getoutput(cmd)
+            if 'Converted successfully' not in output:
+                print(f'Error parsing {edf}', '-'*80, output, '-'*80, sep='\n')
+                continue
+    if session['status'] in ('complete', 'emergency'):  # finished; nothing more will be written
+        ledger.update(wid, processed=time.time())
+
 
+# optimal paths and regret, solved for all trials at once
+annotate([t for t in trials if 'events' in t and 'graph' in t.get('trial', {})])
 
 os.makedirs(f'data/processed/{VERSION}/', exist_ok=True)
 with open(f'data/processed/{VERSION}/trials.json', 'w') as f:
@@ -0,0 +1,255 @@
+"""Replays recorded sessions through GraphTrial and CalibrationTrial on a virtual clock.
+
+    python replay.py data/exp/v1/24-01-01-1200_P3.jsonl
+    python replay.py 'data/exp/v1/*.jsonl' --practice --fixation_detector idt
+
+Clicks and key presses are reconstructed from each trial's event log, the
+mouse follows the recorded trace, and flips land on the recorded flip times,
+so a session replays as fast as the trial code runs. Gaze comes from the
+session's samples.asc if there is one, and otherwise is rebuilt from the
+fixate/unfixate events. The replayed events are compared with the recorded
+ones. Keyword arguments override trial parameters, for testing behaviour
+changes against real sessions.
+"""
+import os
+import glob
+import time
+import logging
+import numpy as np
+
+from headless import headless, HeadlessLink
+from trial import GraphTrial, CalibrationTrial
+from session import load_session
+from asc import read_asc_samples, read_asc_messages
+
+EYELINK_PATH = 'data/eyelink'
+OFF_BOARD = (0., -2.)  # gaze position that hits no node
+
+
+def input_script(events):
+    """(time, kind, arg) for the clicks and key presses behind a trial's events.
+
+    A click's arg is the clicked node, or None for the current node (ending
+    planning). Visits made by do_timeout's random choices are not clicks.
+    """
+    script = []
+    acting = timed_out = False
+    for e in events:
+        kind = e['event']
+        if kind == 'start acting':
+            acting = True
+        elif kind == 'timeout':
+            timed_out = True
+        elif kind == 'end planning':
+            script.append((e['time'], 'click', None))
+        elif kind == 'visit' and acting and not timed_out:
+            script.append((e['time'], 'click', e['state']))
+        elif kind in ('press x', 'press a'):
+            script.append((e['time'], 'key', kind[-1]))
+        elif kind == 'cancel':
+            script.append((e['time'], 'key', 'x'))
+    return script
+
+
+def tracker_offset(messages):
+    """Tracker time minus PsychoPy time, from the time(...) suffix of each message."""
+    offsets = [t - float(text.rsplit('time(', 1)[1].rstrip(')'))
+               for t, text in messages if text.endswith(')') and 'time(' in text]
+    return float(np.median(offsets)) if offsets else None
+
+
+def screen_scale(node_positions, centers):
+    """Half window size (w, h) in tracker pixels, from where the nodes were drawn."""
+    px = np.asarray(node_positions, dtype=float)
+    h, c = np.polyfit(centers[:, 0], px[:, 0], 1)
+    return 2 * c, h
+
+
+def gaze_from_asc(samples, offset, node_positions, centers):
+    """Samples from samples.asc, in PsychoPy time and height units."""
+    w, h = screen_scale(node_positions, centers)
+    t = samples[:, 0] - offset
+    return np.column_stack([t, (samples[:, 1] - w / 2) / h, (h / 2 - samples[:, 2]) / h])
+
+
+def gaze_from_events(events, centers, fixation_lag, rate=250):
+    """Gaze held on each node from its 'fixate state' event until fixation_lag before 'unfixate state'.
+
+    Events are logged when the samples are read, so gaze moves to a node one
+    sample before its fixate event (or at its gaze_time, if recorded).
+    """
+    if not events:
+        return np.empty((0, 3))
+    t = np.arange(events[0]['time'], events[-1]['time'] + 1, 1 / rate)
+    xy = np.tile(OFF_BOARD, (len(t), 1))
+    start = state = None
+    for e in events:
+        begin = e.get('gaze_time', e['time'] - 1 / rate)
+        if e['event'] in ('fixate state', 'unfixate state') and state is not None:
+            end = begin - (fixation_lag if e['event'] == 'unfixate state' else 0)
+            xy[(t >= start) & (t < max(end, start + 1 / rate))] = centers[state]
+            state = None
+        if e['event'] == 'fixate state':
+            start, state = begin, e['state']
+    if state is not None:
+        xy[t >= start] = centers[state]
+    return np.column_stack([t, xy])
+
+
+class ReplayLink(HeadlessLink):
+    """Returns recorded gaze samples as the virtual clock passes them."""
+    def __init__(self, clock, samples):
+        super().__init__(clock)
+        self.recorded = samples
+        self.i = np.searchsorted(samples[:, 0], clock.getTime(), side='right')
+
+    def read_samples(self):
+        j = np.searchsorted(self.recorded[:, 0], self.clock.getTime(), side='right')
+        samples = self.recorded[self.i:j]
+        self.i = j
+        return samples
+
+
+class ReplayDriver(object):
+    """Feeds one recorded trial's clicks, keys and mouse trace to the trial being replayed."""
+    def __init__(self, win, events):
+        self.win = win
+        self.events = events
+        self.mouse = events.mouse
+        self.trial = None
+        win.callOnFlip(self.on_flip)
+
+    def load(self, data, centers):
+        """Starts the clock at the trial's first event; set .trial before running it."""
+        self.centers = centers
+        self.script = input_script(data['events'])
+        self.mouse_trace = np.asarray(data.get('mouse', []), dtype=float).reshape(-1, 3)
+        self.win.schedule = np.asarray(data.get('flips', []), dtype=float)
+        self.win.clock.t = self.win.lastFrameT = data['events'][0]['time']
+        self.events.keys = []
+
+    def on_flip(self, t):
+        self.mouse.pressed = [0, 0, 0]
+        trace = self.mouse_trace
+        i = np.searchsorted(trace[:, 0], t, side='right') - 1
+        if i >= 0:
+            self.mouse.pos = trace[i, 1:].copy()
+        # inputs that happened before the next flip are seen by the loop after this one
+        next_flip = self.win.next_flip(t)
+        while self.script and self.script[0][0] < next_flip:
+            _, kind, arg = self.script.pop(0)
+            if kind == 'key':
+                self.events.keys.append(arg)
+                continue
+            state = self.trial.current_state if arg is None else arg
+            self.mouse.pos = self.centers[state].copy()
+            self.mouse.pressed = [1, 0, 0]
+            break  # one click per frame
+
+
+COMPARED = ('event', 'state', 'status')
+
+def compare_events(recorded, replayed):
+    a = [tuple(e.get(k) for k in COMPARED) for e in recorded]
+    b = [tuple(e.get(k) for k in COMPARED) for e in replayed]
+    n = min(len(a), len(b))
+    mismatch = next((i for i in range(n) if a[i] != b[i]), None if len(a) == len(b) else n)
+    dt = np.abs([recorded[i]['time'] - replayed[i]['time'] for i in range(mismatch if mismatch is not None else n)])
+    result = {
+        'match': mismatch is None,
+        'n_recorded': len(a),
+        'n_replayed': len(b),
+        'max_time_error': round(float(dt.max()), 4) if len(dt) else 0.,
+    }
+    if mismatch is not None:
+        result['first_mismatch'] = {
+            'index': mismatch,
+            'recorded': recorded[mismatch] if mismatch < len(a) else None,
+            'replayed': replayed[mismatch] if mismatch < len(b) else None,
+        }
+    return result
+
+
+def replay_trial(win, driver, data, parameters, gaze, practice=False, **overrides):
+    info = dict(data['trial'])
+    kind = info.pop('kind', 'GraphTrial')
+    node_positions = info.pop('node_positions', None)
+    if 'pos' not in info:
+        # not recorded by older versions
+        info['pos'] = (.3, 0) if practice and kind == 'GraphTrial' else (0, 0)
+    prm = {**parameters, **info, **overrides}
+    centers = .7 * np.asarray(prm['layout'], dtype=float) + prm['pos']
+
+    events = data['events']
+    if gaze is not None and node_positions is not None:
+        samples = gaze_from_asc(gaze[0], gaze[1], node_positions, centers)
+    else:
+        samples = gaze_from_events(events, centers, prm.get('fixation_lag', .5))
+
+    driver.load(data, centers)
+    link = ReplayLink(win.clock, samples)
+    if kind == 'CalibrationTrial':
+        gt = CalibrationTrial(win, **prm, eyelink=link)
+        targets = iter([e['state'] for e in events if e['event'] == 'new target'])
+        gt.choose_target = lambda initial: next(targets, 0)
+    else:
+        gt = GraphTrial(win, **prm, eyelink=link)
+    driver.trial = gt
+
+    start = time.perf_counter()
+    gt.run()
+    return {
+        'kind': kind,
+        'n_frames': len(gt.data['flips']),
+        'sec': round(time.perf_counter() - start, 3),
+        **compare_events(events, gt.data['events']),
+    }
+
+
+def replay_session(path, practice=False, eyelink_path=EYELINK_PATH, **overrides):
+    session = load_session(path)
+    wid = os.path.splitext(os.path.basename(path))[0]
+    asc = f'{eyelink_path}/{wid}/samples.asc'
+    gaze = None
+    if os.path.isfile(asc):
+        offset = tracker_offset(read_asc_messages(asc))
+        if offset is not None:
+            gaze = (read_asc_samples(asc), offset)
+
+    trials = [('main', t) for t in session['trial_data']]
+    if practice:
+        trials = [('practice', t) for t in session['practice_data']] + trials
+    results = []
+    with headless(driver=ReplayDriver) as (win, driver):
+        for kind, data in trials:
+            if not data.get('events'):
+                continue
+            try:
+                result = replay_trial(win, driver, data, session.get('parameters', {}), gaze,
+                                      practice=kind == 'practice', **overrides)
+            except Exception as e:
+                logging.exception('replay failed')
+                result = {'match': False, 'error': repr(e)}
+            results.append({'session': wid, 'block': kind, **result})
+    return results
+
+
+def main(*paths, practice=False, eyelink_path=EYELINK_PATH, verbose=False, **overrides):
+    files = sorted(f for p in paths for f in glob.glob(p))
+    start = time.perf_counter()
+    n_trials = n_match = 0
+    for file in files:
+        results = replay_session(file, practice, eyelink_path, **overrides)
+        matched = sum(r['match'] for r in results)
+        n_trials += len(results)
+        n_match += matched
+        print(f'{file}: {matched}/{len(results)} trials reproduced')
+        for i, r in enumerate(results):
+            if verbose or not r['match']:
+                print(f'  {i:3} {r}')
+    print(f'{n_match}/{n_trials} trials from {len(files)} sessions reproduced in {time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    from fire import Fire
+    Fire(main)
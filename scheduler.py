@@ -0,0 +1,196 @@
+"""Picks main trials adaptively, so sessions reach score_limit in a predictable number of trials.
+
+    python scheduler.py index config/e3                  # precomputes difficulty for the bank
+    python scheduler.py reproduce data/exp/e4/X.jsonl    # reruns a session's choices
+
+Each trial's difficulty comes from its paths: how many there are, the gap
+between the best and second-best path values, and the depth of the best
+path. Trials are split into levels by gap (small gap = hard). The scheduler
+takes the level that is furthest below its share of the trials so far, and
+from it the unused trial whose max_score is closest to what is still needed
+per trial, given the participant's scoring efficiency so far. Ties are
+broken by a seeded RNG and every choice is logged with its inputs, so a
+session's choices can be rerun from its scores.
+"""
+import os
+import json
+import logging
+import numpy as np
+
+from solver import pack, all_paths
+
+FIELDS = ('n_paths', 'gap', 'depth', 'max_score')
+
+
+def difficulty_index(trials):
+    """{field: array} over trials; see FIELDS."""
+    children, rewards, start, n_steps = pack(trials)
+    trial, paths, value = all_paths(children, rewards, start, n_steps)
+    order = np.lexsort((-value, trial))
+    trial, paths, value = trial[order], paths[order], value[order]
+    first = np.flatnonzero(np.r_[True, trial[1:] != trial[:-1]])
+    n_paths = np.diff(np.r_[first, len(trial)])
+    best = value[first]
+    second = np.where(n_paths > 1, value[np.minimum(first + 1, len(value) - 1)], best)
+    return {
+        'n_paths': n_paths,
+        'gap': best - second,
+        'depth': (paths[first] >= 0).sum(axis=1) - 1,
+        'max_score': best,
+    }
+
+
+def index_path(bank):
+    return f'{bank.path}/difficulty.npz'
+
+
+def build_index(config_path):
+    """Writes the difficulty index for every trial in a trial bank."""
+    from trialbank import load_bank
+    bank = load_bank(config_path)
+    if bank is None:
+        raise FileNotFoundError(f'no up-to-date trial bank for {config_path}; run python trialbank.py compile {config_path}')
+    trials = [bank.trial(row) for row in range(bank.meta['n_trials'])]
+    index = difficulty_index(trials)
+    np.savez(index_path(bank), fingerprint=bank.fingerprint, **index)
+    print(f'wrote {index_path(bank)} for {len(trials)} trials')
+
+
+def load_index(trials):
+    """The difficulty index for trials, from the bank's precomputed one if there is one and it is current."""
+    from trialbank import TrialList
+    if isinstance(trials, TrialList) and os.path.isfile(index_path(trials.bank)):
+        with np.load(index_path(trials.bank)) as index:
+            if 'fingerprint' in index.files and index['fingerprint'].item() == trials.bank.fingerprint:
+                return {k: index[k][trials.start:trials.stop] for k in FIELDS}
+        logging.warning('%s is out of date; computing difficulty (run python scheduler.py index)',
+                        index_path(trials.bank))
+    return difficulty_index(list(trials))
+
+
+class Scheduler(object):
+    """Chooses the next trial; call update(score) after each one is run.
+
+    target_trials is the number of trials the session should take to reach
+    score_limit (by default, what an average trial at the prior efficiency
+    would give), and max_trials bounds the session.
+    """
+    def __init__(self, trials, score_limit, target_trials=None, max_trials=None, n_levels=3,
+                 efficiency=.8, prior_weight=20, seed=0):
+        self.trials = trials
+        self.index = load_index(trials)
+        self.score_limit = score_limit
+        self.prior = (efficiency, prior_weight)
+        self.max_trials = min(max_trials or len(trials), len(trials))
+        max_score = self.index['max_score']
+        if target_trials is None:
+            target_trials = int(np.ceil(score_limit / (efficiency * max(max_score.mean(), 1))))
+        self.target_trials = min(target_trials, self.max_trials)
+
+        # levels by gap, hardest (smallest gap) first
+        gap = self.index['gap']
+        edges = np.quantile(gap, np.linspace(0, 1, n_levels + 1)[1:-1])
+        self.level = np.searchsorted(edges, gap, side='right')
+        self.n_levels = n_levels
+        self.counts = np.zeros(n_levels, int)
+        self.available = np.ones(len(trials), bool)
+        self.rng = np.random.default_rng(seed)
+        self.seed = seed
+        self.options = dict(score_limit=score_limit, target_trials=self.target_trials, max_trials=self.max_trials,
+                            n_levels=n_levels, efficiency=efficiency, prior_weight=prior_weight, seed=seed)
+        self.points = 0.
+        self.possible = 0.
+        self.choices = []
+
+    def __len__(self):
+        return self.max_trials
+
+    @property
+    def efficiency(self):
+        e, w = self.prior
+        return (e * w + self.points) / (w + self.possible)
+
+    def choose(self):
+        """Index of the next trial in trials, or None when the session should end."""
+        n_done = len(self.choices)
+        if n_done >= self.max_trials or self.points >= self.score_limit or not self.available.any():
+            return None
+        open_levels = [l for l in range(self.n_levels) if (self.available & (self.level == l)).any()]
+        deficit = {l: self.counts[l] - (n_done + 1) / self.n_levels for l in open_levels}
+        level = min(open_levels, key=lambda l: (deficit[l], l))
+
+        need = self.score_limit - self.points
+        left = max(self.target_trials - n_done, 1)
+        desired = need / left / self.efficiency
+        candidates = np.flatnonzero(self.available & (self.level == level))
+        distance = np.abs(self.index['max_score'][candidates] - desired)
+        closest = candidates[distance == distance.min()]
+        i = int(self.rng.choice(closest))
+
+        self.available[i] = False
+        self.counts[level] += 1
+        choice = {
+            'n': n_done,
+            'trial': i,
+            'level': int(level),
+            'desired_max_score': round(float(desired), 3),
+            'efficiency': round(float(self.efficiency), 3),
+            'points': self.points,
+            'n_closest': len(closest),
+            **{k: self.index[k][i].item() for k in FIELDS},
+        }
+        if n_done == 0:
+            choice['options'] = self.options
+        self.choices.append(choice)
+        logging.info('schedule %s', choice)
+        return i
+
+    def update(self, score):
+        """Records the score on the last chosen trial, or None if it wasn't played (e.g. recalibration)."""
+        if score is None:
+            return
+        self.points += score
+        self.possible += self.choices[-1]['max_score']
+
+    def __iter__(self):
+        """Yields trials until the session should end; update() must be called between them."""
+        while True:
+            i = self.choose()
+            if i is None:
+                return
+            yield self.trials[i]
+
+
+def reproduce(session, config_path=None, **kws):
+    """Reruns a session's scheduler from its recorded scores; True if every choice matches."""
+    from session import load_session
+    from trialbank import load_bank
+    data = load_session(session)
+    recorded = [t['schedule'] for t in data['trial_data'] if 'schedule' in t]
+    if not recorded:
+        print('no scheduled trials in', session)
+        return False
+    config_path = config_path or recorded[0]['config_path']
+    number = recorded[0]['config_number']
+    bank = load_bank(config_path)
+    if bank is not None:
+        trials = bank.trials(number)['main']
+    else:
+        with open(f'{config_path}/{number}.json') as f:
+            trials = json.load(f)['trials']['main']
+    scheduler = Scheduler(trials, **{**recorded[0]['options'], **kws})
+    for k, rec in enumerate(recorded):
+        while len(scheduler.choices) < rec['n']:
+            scheduler.choose()  # a trial that crashed, so wasn't recorded
+        i = scheduler.choose()
+        if i != rec['trial']:
+            print(f'choice {k} differs: recorded trial {rec["trial"]}, rerun chose {i}')
+            return False
+        scheduler.update(rec['score'])
+    print(f'all {len(recorded)} choices reproduced')
+    return True
+
+
+if __name__ == '__main__':
+    from fire import Fire
+    Fire({'index': build_index, 'reproduce': reproduce})
@@ -0,0 +1,161 @@
+import os
+import json
+import logging
+import numpy as np
+
+from util import jsonify
+from buffers import ColumnBuffer
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+class SessionWriter(object):
+    """Append-only session file with one JSON record per line.
+
+    The first record is a header (id, config number, parameters), followed by
+    one record per trial, written and fsynced as soon as the trial is done.
+    The footer is written by close(). A crash loses at most the current trial.
+    """
+    def __init__(self, path, **header):
+        self.path = path
+        self.closed = False
+        self.counts = {}
+        self.file = open(path, 'a')
+        self.write({'record': 'header', **header})
+        logging.info('writing session data to %s', path)
+
+    def write(self, record):
+        self.file.write(jsonify(record) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def write_trial(self, kind, data):
+        index = self.counts.get(kind, 0)
+        self.counts[kind] = index + 1
+        self.write({'record': 'trial', 'kind': kind, 'index': index, 'data': data})
+
+    def close(self, **footer):
+        if self.closed:
+            return
+        self.write({'record': 'footer', 'counts': self.counts, **footer})
+        self.file.close()
+        self.closed = True
+        logging.info('wrote %s', self.path)
+
+
+class HDF5SessionWriter(object):
+    """Session file in HDF5, with the same interface as SessionWriter.
+
+    Each trial is a group /{kind}/{index}. Numeric traces (flips, mouse,
+    node_positions) are stored as compressed, chunked float64 datasets and the
+    event log as a (time, event, info) table, with info JSON-encoded. Everything
+    else is kept as JSON attributes. The file is flushed after every trial.
+    """
+    traces = ('flips', 'mouse')
+
+    def __init__(self, path, **header):
+        assert h5py is not None, 'h5py is required for the hdf5 data format'
+        self.path = path
+        self.closed = False
+        self.counts = {}
+        self.file = h5py.File(path, 'a')
+        self.file.attrs['header'] = jsonify(header)
+        self.file.flush()
+        logging.info('writing session data to %s', path)
+
+    def _dataset(self, group, name, x):
+        x = np.asarray(x, dtype=float)
+        if x.size:
+            group.create_dataset(name, data=x, compression='gzip', shuffle=True, chunks=True)
+        else:
+            group.create_dataset(name, data=x)
+
+    def write_trial(self, kind, data):
+        index = self.counts.get(kind, 0)
+        self.counts[kind] = index + 1
+        group = self.file.create_group(f'{kind}/{index:04d}')
+        data = dict(data)
+
+        for name in self.traces:
+            if name in data:
+                x = data.pop(name)
+                self._dataset(group, name, x.values() if isinstance(x, ColumnBuffer) else x)
+
+        trial = dict(data.pop('trial', {}))
+        if 'node_positions' in trial:
+            self._dataset(group, 'node_positions', trial.pop('node_positions'))
+        group.attrs['trial'] = jsonify(trial)
+
+        events = data.pop('events', [])
+        string = h5py.string_dtype()
+        table = np.array(
+            [(e['time'], e['event'], jsonify({k: v for k, v in e.items() if k not in ('time', 'event')}))
+             for e in events],
+            dtype=[('time', 'f8'), ('event', object), ('info', object)]
+        )
+        group.create_dataset('events', data=table.astype([('time', 'f8'), ('event', string), ('info', string)]))
+
+        for k, v in data.items():
+            group.attrs[k] = jsonify(v)
+        self.file.flush()
+
+    def close(self, **footer):
+        if self.closed:
+            return
+        self.file.attrs['footer'] = jsonify({'counts': self.counts, **footer})
+        self.file.close()
+        self.closed = True
+        logging.info('wrote %s', self.path)
+
+
+def _load_hdf5_trial(group):
+    data = {'trial': json.loads(group.attrs['trial'])}
+    if 'node_positions' in group:
+        data['trial']['node_positions'] = group['node_positions'][()].tolist()
+    data['events'] = [
+        {'time': float(t), 'event': e.decode(), **json.loads(info)}
+        for t, e, info in group['events'][()]
+    ]
+    for name in HDF5SessionWriter.traces:
+        if name in group:
+            data[name] = group[name][()].tolist()
+    for k, v in group.attrs.items():
+        if k != 'trial':
+            data[k] = json.loads(v)
+    return data
+
+
+def load_hdf5_session(path):
+    with h5py.File(path, 'r') as f:
+        result = json.loads(f.attrs['header'])
+        result['trial_data'] = [_load_hdf5_trial(g) for _, g in sorted(f['main'].items())] if 'main' in f else []
+        result['practice_data'] = [_load_hdf5_trial(g) for _, g in sorted(f['practice'].items())] if 'practice' in f else []
+        footer = json.loads(f.attrs['footer']) if 'footer' in f.attrs else {}
+    result.update(footer)
+    result['complete'] = footer.get('status') == 'complete'
+    return result
+
+
+def load_session(path):
+    """Reads a session file into a dict with trial_data and practice_data lists."""
+    if path.endswith('.h5'):
+        return load_hdf5_session(path)
+    result = {'trial_data': [], 'practice_data': [], 'complete': False}
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning('truncated record in %s', path)
+                break
+            kind = record.pop('record')
+            if kind == 'trial':
+                key = 'trial_data' if record['kind'] == 'main' else 'practice_data'
+                result[key].append(record['data'])
+            else:
+                result.update(record)
+                if kind == 'footer':
+                    result['complete'] = record.get('status') == 'complete'
+    return result
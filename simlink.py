@@ -0,0 +1,468 @@
+"""A simulated EyeLink for load testing the gaze pipeline without a tracker.
+
+SimTracker stands in for pylink.EyeLink: it streams samples and fixation and
+saccade events over a fake link, receives messages and commands, and writes
+an ASC-format data file on the "host", which receiveDataFile copies back as
+the EDF. SimLink is an EyeLink that talks to it, so message queueing, sample
+buffering, drift checks, EDF rotation and save_data all run the real code.
+
+    python main.py --test --sim
+    python main.py --test --sim='{"rate": 2000, "latency": .01, "dropout": .01}'
+    python main.py --test --sim='{"asc": "data/eyelink/P3/samples.asc"}'
+"""
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from collections import deque
+import numpy as np
+
+import pylink
+from psychopy import core
+
+from eyetracking import EyeLink, configure_data, height2pix
+from asc import read_asc_samples, read_asc_events
+
+FIXATION, SACCADE = 0, 1
+
+
+class GazeSource(object):
+    """Gaze over time as segments of (kind, start, end, x0, y0, x1, y1).
+
+    Times are in ms on the tracker clock and positions in tracker pixels.
+    Subclasses add segments in _extend, starting from start on the first
+    call, and say where gaze is in positions.
+    """
+    def __init__(self):
+        self.segments = deque()
+        self.end = None
+
+    def _extend(self, until, start=None):
+        raise NotImplementedError
+
+    def positions(self, t):
+        raise NotImplementedError
+
+    def events(self, t0, t1):
+        """(time, pylink event type, segment) for segments starting or ending in (t0, t1]."""
+        self._extend(t1)
+        out = []
+        for seg in self.segments:
+            kind, start, end = seg[:3]
+            if t0 < start <= t1:
+                out.append((start, pylink.STARTFIX if kind == FIXATION else pylink.STARTSACC, seg))
+            if t0 < end <= t1:
+                out.append((end, pylink.ENDFIX if kind == FIXATION else pylink.ENDSACC, seg))
+        while self.segments and self.segments[0][2] <= t1:
+            self.segments.popleft()
+        return sorted(out, key=lambda e: e[0])
+
+
+class SyntheticGaze(GazeSource):
+    """Fixations on random targets joined by saccades.
+
+    Fixation durations are gamma distributed with the given mean. Saccades
+    take 20 ms plus 66 ms per screen height travelled and follow a smooth
+    step. targets are in height units and can be changed at any time.
+    """
+    def __init__(self, win, targets=None, fixation_ms=250, min_fixation_ms=80, seed=0):
+        super().__init__()
+        self.win = win
+        self.targets = targets
+        self.fixation_ms = fixation_ms
+        self.min_fixation_ms = min_fixation_ms
+        self.rng = np.random.default_rng(seed)
+
+    def _target(self):
+        if self.targets is None or not len(self.targets):
+            pos = self.rng.uniform(-.35, .35, 2)
+        else:
+            pos = self.targets[self.rng.integers(len(self.targets))]
+        return np.array(height2pix(self.win, pos))
+
+    def _extend(self, until, start=None):
+        if self.end is None:
+            self.pos = self._target()
+            self._fixate(until if start is None else start)
+        while self.end < until:
+            target = self._target()
+            amplitude = np.linalg.norm(target - self.pos) / (self.win.size[1] / 2)
+            duration = 20 + 66 * amplitude
+            self.segments.append((SACCADE, self.end, self.end + duration, *self.pos, *target))
+            self.pos = target
+            self._fixate(self.end + duration)
+
+    def _fixate(self, start):
+        shape = 3
+        duration = self.min_fixation_ms + self.rng.gamma(shape, (self.fixation_ms - self.min_fixation_ms) / shape)
+        self.segments.append((FIXATION, start, start + duration, *self.pos, *self.pos))
+        self.end = start + duration
+
+    def positions(self, t):
+        self._extend(t[-1], t[0])
+        xy = np.empty((len(t), 2))
+        for kind, start, end, x0, y0, x1, y1 in self.segments:
+            idx = (t >= start) & (t <= end)
+            if not idx.any():
+                continue
+            p = np.clip((t[idx] - start) / (end - start), 0, 1)[:, None]
+            p = p * p * (3 - 2 * p)
+            xy[idx] = (1 - p) * (x0, y0) + p * (x1, y1)
+        return xy
+
+
+class AscGaze(GazeSource):
+    """Plays back the samples and events of a samples.asc file, looping at the end.
+
+    The recording starts over from the first time gaze is asked for.
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        samples = read_asc_samples(path)
+        if not len(samples):
+            raise ValueError(f'no samples in {path}')
+        self.t = 1000 * samples[:, 0]
+        self.xy = samples[:, 1:]
+        self.recorded = read_asc_events(path)
+        self.recorded[:, 1:3] *= 1000
+        self.period = self.t[-1] - self.t[0] + 1
+        self.origin = None
+        self.n_loops = 0
+
+    def _extend(self, until, start=None):
+        if self.origin is None:
+            self.origin = self.end = until if start is None else start
+        while self.end < until:
+            shift = self.origin + self.n_loops * self.period - self.t[0]
+            for kind, start, end, *pos in self.recorded:
+                self.segments.append((int(kind), start + shift, end + shift, *pos))
+            self.n_loops += 1
+            self.end = self.origin + self.n_loops * self.period
+
+    def positions(self, t):
+        self._extend(t[-1], t[0])
+        r = self.t[0] + (t - self.origin) % self.period
+        return np.column_stack([np.interp(r, self.t, self.xy[:, 0]), np.interp(r, self.t, self.xy[:, 1])])
+
+
+class SimEye(object):
+    def __init__(self, gaze):
+        self.gaze = gaze
+
+    def getGaze(self):
+        return self.gaze
+
+
+class SimSample(object):
+    def __init__(self, t, gaze):
+        self.t = t
+        self.eye = SimEye(gaze)
+
+    def getTime(self):
+        return self.t
+
+    def isLeftSample(self):
+        return True
+
+    def getLeftEye(self):
+        return self.eye
+
+    def getRightEye(self):
+        return None
+
+
+class SimEvent(object):
+    def __init__(self, segment):
+        _, self.start, self.end, x0, y0, x1, y1 = segment
+        self.start_gaze = (x0, y0)
+        self.end_gaze = (x1, y1)
+
+    def getStartTime(self):
+        return self.start
+
+    def getEndTime(self):
+        return self.end
+
+    def getStartGaze(self):
+        return self.start_gaze
+
+    def getEndGaze(self):
+        return self.end_gaze
+
+    def getAverageGaze(self):
+        return tuple((np.array(self.start_gaze) + self.end_gaze) / 2)
+
+
+class SimTracker(object):
+    """Stands in for pylink.EyeLink.
+
+    Samples are generated when the link is read, up to latency seconds
+    before now. noise is the SD of the gaze noise in tracker pixels and
+    drift the SD of the offset it builds up per minute, until the next drift
+    correction or calibration. Each sample is lost on the link (but still
+    written to the data file) with probability dropout, and blinks, reported
+    as missing data, start at blink_rate per second. Sending a message or
+    command takes message_delay seconds.
+    """
+    def __init__(self, source, rate=1000, latency=.002, noise=.5, drift=0., dropout=0., blink_rate=0.,
+                 message_delay=0., host_dir=None, seed=0):
+        if not 250 <= rate <= 2000:
+            raise ValueError('rate must be between 250 and 2000 Hz')
+        self.source = source
+        self.interval = 1000 / rate
+        self.latency = latency
+        self.noise = noise
+        self.drift = drift
+        self.dropout = dropout
+        self.blink_rate = blink_rate
+        self.message_delay = message_delay
+        self.host_dir = host_dir or tempfile.mkdtemp(prefix='simlink-')
+        self.rng = np.random.default_rng(seed)
+        self.clock_offset = self.rng.uniform(1e3, 1e4)  # the tracker's clock started before ours
+        self.lock = threading.Lock()  # messages arrive from the sender thread
+
+        self.connected = True
+        self.recording = False
+        self.data_file = None
+        self.queue = deque()
+        self.current = None
+        self.newest = None
+        self.next_sample = None
+        self.last_event = None
+        self.offset = np.zeros(2)
+        self.blink_until = -np.inf
+        self.messages = []
+        self.commands = []
+        self.n_samples = self.n_dropped = self.n_blinks = self.n_events = 0
+
+    def trackerTime(self):
+        return 1000 * (core.getTime() + self.clock_offset)
+
+    def getTrackerVersionString(self):
+        return 'SIMLINK 5.00'
+
+    def isConnected(self):
+        return self.connected
+
+    def close(self):
+        self.setOfflineMode()
+        self.connected = False
+
+    def _write(self, line):
+        if self.data_file is not None:
+            self.data_file.write(line + '\n')
+
+    def sendCommand(self, cmd):
+        time.sleep(self.message_delay)
+        with self.lock:
+            self.commands.append(cmd)
+
+    def sendMessage(self, text):
+        """Records text; a leading integer says how many ms ago it happened."""
+        time.sleep(self.message_delay)
+        t = self.trackerTime()
+        head, _, rest = text.partition(' ')
+        if head.isdigit() and rest:
+            t -= int(head)
+            text = rest
+        with self.lock:
+            self.messages.append((t, text))
+            self._write(f'MSG\t{int(t)} {text}')
+
+    # data file
+
+    def openDataFile(self, name):
+        with self.lock:
+            if self.data_file is not None:
+                self.data_file.close()
+            self.data_file = open(os.path.join(self.host_dir, name), 'w')
+            self._write(f'** CONVERTED FROM {name} USING SIMLINK')
+            self._write(f'** DATE: {time.ctime()}')
+
+    def closeDataFile(self):
+        with self.lock:
+            if self.data_file is not None:
+                self.data_file.close()
+                self.data_file = None
+
+    def receiveDataFile(self, src, dest):
+        shutil.copyfile(os.path.join(self.host_dir, src), dest)
+
+    # recording
+
+    def setOfflineMode(self):
+        if self.recording:
+            self.stopRecording()
+
+    def startRecording(self, file_samples=1, file_events=1, link_samples=1, link_events=1):
+        now = self.trackerTime() - 1000 * self.latency
+        self.next_sample = self.last_event = now
+        self.queue.clear()
+        self.recording = True
+        with self.lock:
+            self._write(f'START\t{int(now)} \tLEFT\tSAMPLES\tEVENTS')
+
+    def stopRecording(self):
+        self._generate()
+        self.recording = False
+        with self.lock:
+            self._write(f'END\t{int(self.trackerTime())} \tSAMPLES\tEVENTS')
+
+    def doDriftCorrect(self, x, y, draw=1, allow_setup=1):
+        self.offset[:] = 0
+        return 0
+
+    def doTrackerSetup(self, *args):
+        self.offset[:] = 0
+
+    def _generate(self):
+        if not self.recording:
+            return
+        t = np.arange(self.next_sample, self.trackerTime() - 1000 * self.latency, self.interval)
+        if not len(t):
+            return
+        self.next_sample = t[-1] + self.interval
+
+        xy = self.source.positions(t)
+        if self.drift:
+            steps = self.drift / np.sqrt(60e3 / self.interval) * self.rng.standard_normal((len(t), 2))
+            drift = self.offset + np.cumsum(steps, axis=0)
+            self.offset = drift[-1]
+            xy += drift
+        else:
+            xy += self.offset
+        xy += self.noise * self.rng.standard_normal(xy.shape)
+
+        missing = t < self.blink_until
+        if self.blink_rate:
+            for i in np.flatnonzero(self.rng.random(len(t)) < self.blink_rate * self.interval / 1000):
+                if not missing[i]:
+                    self.blink_until = t[i] + self.rng.uniform(80, 200)
+                    missing |= (t >= t[i]) & (t < self.blink_until)
+                    self.n_blinks += 1
+        dropped = self.rng.random(len(t)) < self.dropout
+
+        data = []
+        lines = []
+        for ti, (x, y), m, d in zip(t, xy, missing, dropped):
+            if m:
+                gaze = (pylink.MISSING_DATA, pylink.MISSING_DATA)
+                lines.append((ti, f'{int(ti)}\t   .\t   .\t    0.0\t...'))
+            else:
+                gaze = (x, y)
+                lines.append((ti, f'{int(ti)}\t{x:7.1f}\t{y:7.1f}\t 1000.0\t...'))
+            if not d:
+                data.append((ti, pylink.SAMPLE_TYPE, SimSample(ti, gaze)))
+        self.n_samples += len(t)
+        self.n_dropped += int(dropped.sum())
+        self.newest = SimSample(t[-1], gaze)
+
+        for ti, kind, seg in self.source.events(self.last_event, t[-1]):
+            data.append((ti, kind, SimEvent(seg)))
+            lines.append((ti, self._event_line(kind, seg)))
+            self.n_events += 1
+        self.last_event = t[-1]
+
+        data.sort(key=lambda d: d[0])
+        self.queue.extend((kind, obj) for _, kind, obj in data)
+        lines.sort(key=lambda d: d[0])
+        with self.lock:
+            for _, line in lines:
+                self._write(line)
+
+    def _event_line(self, kind, seg):
+        _, start, end, x0, y0, x1, y1 = seg
+        duration = int(end) - int(start) + 1
+        if kind == pylink.STARTFIX:
+            return f'SFIX L   {int(start)}'
+        if kind == pylink.STARTSACC:
+            return f'SSACC L  {int(start)}'
+        if kind == pylink.ENDFIX:
+            return f'EFIX L   {int(start)}\t{int(end)}\t{duration}\t{x1:7.1f}\t{y1:7.1f}\t   1000'
+        amplitude = np.hypot(x1 - x0, y1 - y0) / 30  # about 30 px per degree
+        return (f'ESACC L  {int(start)}\t{int(end)}\t{duration}\t{x0:7.1f}\t{y0:7.1f}\t{x1:7.1f}\t{y1:7.1f}'
+                f'\t{amplitude:6.2f}\t{amplitude * 40:6.0f}')
+
+    # link
+
+    def getNextData(self):
+        if not self.queue:
+            self._generate()
+        if not self.queue:
+            return 0
+        kind, self.current = self.queue.popleft()
+        return kind
+
+    def getFloatData(self):
+        return self.current
+
+    def getNewestSample(self):
+        self._generate()
+        return self.newest
+
+    def stats(self):
+        return {
+            'n_samples': self.n_samples,
+            'n_dropped': self.n_dropped,
+            'n_blinks': self.n_blinks,
+            'n_events': self.n_events,
+            'n_messages': len(self.messages),
+            'n_commands': len(self.commands),
+        }
+
+
+class SimLink(EyeLink):
+    """EyeLink connected to a SimTracker instead of the tracker at 100.1.1.1.
+
+    Gaze is replayed from asc (a samples.asc file) if given, and is
+    otherwise synthetic, fixating points in targets (height units; anywhere
+    on the screen by default). Other keyword arguments go to SimTracker,
+    except those taken by EyeLink.
+    """
+    def __init__(self, win, uniqueid, asc=None, targets=None, rate=1000, latency=.002, noise=.5, drift=0.,
+                 dropout=0., blink_rate=0., message_delay=0., seed=0, **kws):
+        source = AscGaze(asc) if asc else SyntheticGaze(win, targets, seed=seed)
+        self.sim = dict(source=source, rate=rate, latency=latency, noise=noise, drift=drift, dropout=dropout,
+                        blink_rate=blink_rate, message_delay=message_delay, seed=seed)
+        super().__init__(win, uniqueid, **kws)
+
+    def connect(self, dummy_mode=False):
+        logging.info('Initializing simulated tracker %s', self.sim)
+        self.tracker = SimTracker(**self.sim)
+        self.tracker.openDataFile(self.edf_file)
+        configure_data(self.tracker)
+        self.setup_calibration()
+        self.tracker.setOfflineMode()
+
+    @property
+    def targets(self):
+        return self.tracker.source.targets
+
+    @targets.setter
+    def targets(self, targets):
+        self.tracker.source.targets = targets
+
+    def setup_calibration(self, full_screen=False):
+        self.message('Set up calibration')
+        self.send_screen_coords()
+
+    def calibrate(self):
+        logging.info('SimLink calibrate')
+        with self.link_lock:
+            self.tracker.doTrackerSetup()
+
+    def fake_drift_check(self, pos=(0,0)):
+        logging.info('SimLink fake_drift_check')
+        return 'ok'
+
+    def convert_edf(self, edf, asc):
+        # the simulated EDF is already in ASC format
+        shutil.copyfile(edf, asc)
+        return asc
+
+    def save_data(self):
+        super().save_data()
+        logging.info('SimLink stats %s', self.tracker.stats())
@@ -0,0 +1,226 @@
+"""Predicts how many trials and minutes sessions take, by simulating participants on every config.
+
+    python simulate.py                                  # optimal policy, config/e3, score_limit 400
+    python simulate.py --policy noisy --n_sims 20 --score_limit 300
+    python simulate.py --policy greedy --schedule       # trials picked by the adaptive scheduler
+
+Each simulated participant plays the main trials of one config the way
+run_main does, until the score reaches score_limit or the trials run out.
+A trial's score is the sum of the rewards on its path, start included, as
+in GraphTrial. Policies choose each move:
+
+    optimal  the best path, ties broken at random
+    noisy    softmax over the best value through each child (temperature)
+    greedy   the child with the biggest reward
+    random   a random child, at the participant's usual pace
+    timeout  no moves at all, so do_timeout's random walk makes them
+
+Time is modelled from the experiment's fixed delays (animations, pauses,
+the timeout blink and its 0.8 s per random move) plus lognormal times for
+the participant's own actions (see TIMING). Configs run in parallel in a
+process pool.
+"""
+import os
+import json
+import time
+from multiprocessing import Pool
+import numpy as np
+
+from solver import pack, values
+from scheduler import Scheduler, difficulty_index
+
+CONFIG_PATH = 'config/e3'
+
+# seconds; the *_median times are lognormal with sigma TIMING['sigma']
+TIMING = {
+    'sigma': .5,
+    'message_median': 1.5,       # reading "your current score is..." and pressing space
+    'start_median': 1.,          # fixating the start node
+    'plan_median': 2.,           # planning, plus plan_per_path for each path in the graph
+    'plan_per_path': .15,
+    'move_median': .6,           # each click while acting
+    'trial_overhead': 1.3,       # label pops, pause and fade out at the end of a trial
+    'timeout_blink': 1.8,        # do_timeout's blink before the random walk
+    'timeout_step': .8,          # per random move
+    'calibration': 30.,          # calibrate_gaze_tolerance, every calibrate_every trials
+    'calibrate_every': 20,
+}
+
+
+def optimal(children, rewards, value, s, rng, temperature=None):
+    v = value[children]
+    return rng.choice(children[v == v.max()])
+
+def noisy(children, rewards, value, s, rng, temperature=1.):
+    v = value[children] / temperature
+    p = np.exp(v - v.max())
+    return rng.choice(children, p=p / p.sum())
+
+def greedy(children, rewards, value, s, rng, temperature=None):
+    r = rewards[children]
+    return rng.choice(children[r == r.max()])
+
+def random(children, rewards, value, s, rng, temperature=None):
+    return rng.choice(children)
+
+def timeout(children, rewards, value, s, rng, temperature=None):
+    # never called: play() lets the trial time out and walks randomly
+    return rng.choice(children)
+
+POLICIES = {'optimal': optimal, 'noisy': noisy, 'greedy': greedy, 'random': random, 'timeout': timeout}
+
+
+def load_trials(config_path, number):
+    from trialbank import load_bank
+    bank = load_bank(config_path)
+    if bank is not None:
+        return list(bank.trials(number)['main'])
+    with open(f'{config_path}/{number}.json') as f:
+        return json.load(f)['trials']['main']
+
+
+def config_numbers(config_path):
+    from trialbank import load_bank
+    bank = load_bank(config_path)
+    if bank is not None:
+        return bank.config_numbers
+    return sorted(int(fn[:-5]) for fn in os.listdir(config_path) if fn[:-5].isdigit())
+
+
+def play(graph, rewards, value, start, n_paths, policy, rng, timing, act_time=None, temperature=1.):
+    """(score, seconds) for one trial."""
+    def lognormal(median):
+        return median * np.exp(timing['sigma'] * rng.standard_normal())
+
+    t = lognormal(timing['start_median'])
+    timed_out = policy is timeout
+    if timed_out:
+        t += act_time + timing['timeout_blink']
+    else:
+        t += lognormal(timing['plan_median'] + timing['plan_per_path'] * n_paths)
+    state, score = start, rewards[start]
+    acting = 0.
+    while graph[state]:
+        children = np.array(graph[state])
+        if not timed_out:
+            step = lognormal(timing['move_median'])
+            if act_time is not None and acting + step > act_time:
+                timed_out = True
+                t += act_time - acting + timing['timeout_blink']
+            else:
+                acting += step
+                t += step
+        if timed_out:
+            state = rng.choice(children)
+            t += timing['timeout_step']
+        else:
+            state = policy(children, rewards, value, state, rng, temperature)
+        score += rewards[state]
+    return score, t + timing['trial_overhead']
+
+
+def simulate_session(trials, value, n_paths, score_limit, policy, rng, timing, schedule=False, act_time=None,
+                     temperature=1., seed=0):
+    """Plays trials like run_main. Returns (n_trials, seconds, reached score_limit)."""
+    if schedule:
+        scheduler = Scheduler(trials, score_limit, seed=seed, **(schedule if isinstance(schedule, dict) else {}))
+        order = iter(scheduler.choose, None)
+    else:
+        scheduler = None
+        order = iter(range(len(trials)))
+    total = seconds = 0.
+    n = 0
+    for i in order:
+        if total >= score_limit:
+            break
+        seconds += timing['message_median'] * np.exp(timing['sigma'] * rng.standard_normal())
+        t = trials[i]
+        score, sec = play(t['graph'], np.asarray(t['rewards']), value[i], t['start'], n_paths[i], policy, rng,
+                          timing, act_time, temperature)
+        total += int(score)
+        seconds += sec
+        n += 1
+        if scheduler:
+            scheduler.update(score)
+        if n % timing['calibrate_every'] == 0 and total < .9 * score_limit:
+            seconds += timing['calibration']
+    return n, seconds, total >= score_limit
+
+
+def _run_config(args):
+    config_path, number, n_sims, score_limit, policy, timing, kws, seed = args
+    trials = load_trials(config_path, number)
+    children, rewards, start, n_steps = pack(trials)
+    value = values(children, rewards, n_steps)
+    n_paths = difficulty_index(trials)['n_paths']
+    out = []
+    for k in range(n_sims):
+        rng = np.random.default_rng([seed, number, k])
+        n, sec, reached = simulate_session(trials, value, n_paths, score_limit, POLICIES[policy], rng, timing,
+                                           seed=number, **kws)
+        out.append({'config': number, 'sim': k, 'n_trials': n, 'minutes': sec / 60, 'reached': reached})
+    return out
+
+
+def summarize(x):
+    x = np.asarray(x, dtype=float)
+    return {
+        'mean': round(float(x.mean()), 2),
+        'sd': round(float(x.std()), 2),
+        **{f'p{q}': round(float(np.percentile(x, q)), 2) for q in (5, 25, 50, 75, 95)},
+        'max': round(float(x.max()), 2),
+    }
+
+
+def run(config_path=CONFIG_PATH, policy='optimal', score_limit=400, n_sims=10, configs=None, schedule=False,
+        act_time=None, temperature=1., processes=None, seed=0, out=None, **timing):
+    """Simulates n_sims sessions per config and prints distributions of trials-to-limit and minutes.
+
+    Keyword arguments that match TIMING override it.
+    """
+    unknown = set(timing) - set(TIMING)
+    if unknown:
+        raise TypeError(f'unknown arguments {unknown}')
+    timing = {**TIMING, **timing}
+    if policy == 'timeout' and act_time is None:
+        raise ValueError('without act_time a trial never times out')
+    numbers = configs or config_numbers(config_path)
+    kws = dict(schedule=schedule, act_time=act_time, temperature=temperature)
+    jobs = [(config_path, n, n_sims, score_limit, policy, timing, kws, seed) for n in numbers]
+    start = time.perf_counter()
+    with Pool(processes) as pool:
+        results = [r for rs in pool.map(_run_config, jobs) for r in rs]
+
+    reached = [r for r in results if r['reached']]
+    report = {
+        'config_path': config_path,
+        'policy': policy,
+        'score_limit': score_limit,
+        'n_configs': len(numbers),
+        'n_sims': n_sims,
+        'schedule': schedule,
+        'timing': timing,
+        'reached_limit': round(len(reached) / len(results), 3),
+        'trials_to_limit': summarize([r['n_trials'] for r in reached]) if reached else None,
+        'minutes': summarize([r['minutes'] for r in results]),
+        'sessions': results,
+    }
+    print(f"{policy}, score_limit {score_limit}: {len(results)} sessions over {len(numbers)} configs "
+          f"in {time.perf_counter() - start:.1f}s")
+    print(f"  reached the limit in {100 * report['reached_limit']:.0f}% of sessions")
+    for name in ('trials_to_limit', 'minutes'):
+        s = report[name]
+        if s:
+            print(f"  {name:16} mean {s['mean']:6.1f}  p5 {s['p5']:6.1f}  p50 {s['p50']:6.1f}  "
+                  f"p95 {s['p95']:6.1f}  max {s['max']:6.1f}")
+    if out:
+        os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+        with open(out, 'w') as f:
+            json.dump(report, f)
+        print('wrote', out)
+    return report
+
+
+if __name__ == '__main__':
+    from fire import Fire
+    Fire(run)
@@ -0,0 +1,182 @@
+"""Best paths through trial graphs, solved for many trials at once.
+
+    python solver.py validate config/e3     # checks every config's max_score
+
+Trials are packed into padded arrays (children[t, node, k], -1 for no child;
+rewards[t, node]), the same layout as a trial bank, and solved with
+level-synchronous dynamic programming: each iteration extends every node's
+value by one more move, in all trials at once. A path's value includes the
+start node's reward, as a trial's score does.
+"""
+import os
+import json
+import time
+import numpy as np
+
+
+def pack(trials):
+    """children (T, N, C), rewards (T, N), start (T,), n_steps (T,) for a list of trial dicts."""
+    n = max(len(t['graph']) for t in trials)
+    c = max(1, max(len(ch) for t in trials for ch in t['graph']))
+    children = np.full((len(trials), n, c), -1, dtype=np.int64)
+    rewards = np.zeros((len(trials), n))
+    for i, t in enumerate(trials):
+        for j, ch in enumerate(t['graph']):
+            children[i, j, :len(ch)] = ch
+        rewards[i, :len(t['rewards'])] = t['rewards']
+    start = np.array([t['start'] for t in trials])
+    n_steps = np.array([t.get('n_steps', -1) for t in trials])
+    return children, rewards, start, n_steps
+
+
+def values(children, rewards, n_steps=None):
+    """value[t, node]: the most points from node on, counting node's own reward.
+
+    A path keeps moving until it reaches a leaf or has made n_steps moves
+    (n_steps < 0 for no limit).
+    """
+    T, N, C = children.shape
+    children = np.asarray(children)
+    has_child = children >= 0
+    leaf = ~has_child.any(axis=2)
+    idx = np.where(has_child, children, 0).reshape(T, N * C)
+    limit = np.full(T, N) if n_steps is None else np.where(np.asarray(n_steps) < 0, N, n_steps)
+
+    value = np.asarray(rewards, dtype=float).copy()
+    for k in range(1, limit.max() + 1):
+        child_value = np.take_along_axis(value, idx, axis=1).reshape(T, N, C)
+        best = np.where(has_child, child_value, -np.inf).max(axis=2)
+        new = rewards + np.where(leaf, 0, best)
+        active = (k <= limit)[:, None]
+        if np.array_equal(new[active[:, 0]], value[active[:, 0]]):
+            break  # every path has reached a leaf
+        value = np.where(active, new, value)
+    return value
+
+
+def max_scores(children, rewards, start, n_steps=None):
+    value = values(children, rewards, n_steps)
+    return value[np.arange(len(start)), start]
+
+
+def all_paths(children, rewards, start, n_steps=None):
+    """Every path from start, for every trial.
+
+    Returns (trial, paths, value): trial[p] is the trial path p belongs to,
+    paths[p] its nodes padded with -1, and value[p] its total reward.
+    Paths are expanded one level at a time across all trials.
+    """
+    T, N, C = children.shape
+    limit = np.full(T, N) if n_steps is None else np.where(np.asarray(n_steps) < 0, N, n_steps)
+    trial = np.arange(T)
+    paths = np.asarray(start)[:, None]
+    for depth in range(limit.max()):
+        last = paths[:, -1]
+        kids = np.where(last[:, None] >= 0, children[trial, last.clip(0)], -1)
+        kids[depth >= limit[trial]] = -1
+        growing = (kids >= 0).any(axis=1)
+        if not growing.any():
+            break
+        # finished paths carry on padded; growing ones branch into one row per child
+        done_rows = np.column_stack([paths[~growing], np.full((~growing).sum(), -1)])
+        p, k = np.nonzero(kids[growing] >= 0)
+        grow_rows = np.column_stack([paths[growing][p], kids[growing][p, k]])
+        order = np.argsort(np.concatenate([trial[~growing], trial[growing][p]]), kind='stable')
+        paths = np.concatenate([done_rows, grow_rows])[order]
+        trial = np.concatenate([trial[~growing], trial[growing][p]])[order]
+    value = np.where(paths >= 0, np.asarray(rewards)[trial[:, None], paths.clip(0)], 0).sum(axis=1)
+    return trial, paths, value
+
+
+def optimal_paths(children, rewards, start, n_steps=None, tol=1e-9):
+    """For each trial, the list of its best paths (as lists of nodes)."""
+    trial, paths, value = all_paths(children, rewards, start, n_steps)
+    best = np.full(len(start), -np.inf)
+    np.maximum.at(best, trial, value)
+    out = [[] for _ in range(len(start))]
+    for t, p in zip(trial[value >= best[trial] - tol], paths[value >= best[trial] - tol]):
+        out[t].append([int(x) for x in p if x >= 0])
+    return out
+
+
+def max_score(trial):
+    """The best score possible on one trial."""
+    return float(max_scores(*pack([trial]))[0])
+
+
+def visited(events):
+    return [e['state'] for e in events if e['event'] == 'visit']
+
+
+def annotate(trials):
+    """Adds the optimal paths, max_score and the participant's regret to recorded trial data.
+
+    The participant's path is every visited state, as scored by the trial.
+    """
+    info = [t['trial'] for t in trials]
+    children, rewards, start, n_steps = pack(info)
+    best = optimal_paths(children, rewards, start, n_steps)
+    scores = max_scores(children, rewards, start, n_steps)
+    for t, paths, top in zip(trials, best, scores):
+        path = visited(t['events'])
+        score = float(sum(t['trial']['rewards'][s] for s in path))
+        t['path'] = path
+        t['score'] = score
+        t['max_score'] = float(top)
+        t['regret'] = float(top) - score
+        t['optimal_paths'] = paths
+        t['chose_optimal'] = path in paths
+    return trials
+
+
+def check_trials(trials, tol=1e-6):
+    """Indices of trials whose max_score differs from the solved one, and the solved scores."""
+    scores = max_scores(*pack(trials))
+    stored = np.array([t['max_score'] for t in trials], dtype=float)
+    return np.flatnonzero(np.abs(scores - stored) > tol), scores
+
+
+def validate(config_path):
+    """Checks max_score for every trial of every config, from the trial bank if there is one."""
+    from trialbank import load_bank
+    start_time = time.perf_counter()
+    bank = load_bank(config_path)
+    if bank is not None:
+        c = bank.columns
+        children = np.asarray(c['graph'], dtype=np.int64)
+        n_nodes = np.asarray(c['n_nodes'])
+        rewards = np.where(np.arange(children.shape[1]) < n_nodes[:, None], c['rewards'], 0)
+        scores = max_scores(children, rewards, np.asarray(c['start'], dtype=np.int64), np.asarray(c['n_steps']))
+        bad = np.flatnonzero(np.abs(scores - c['max_score']) > 1e-6)
+        n_trials = len(scores)
+        where = {}
+        for number in bank.config_numbers:
+            offsets = bank.offsets[bank.index[number]]
+            for k, block in enumerate(bank.meta['blocks']):
+                for row in bad[(bad >= offsets[k]) & (bad < offsets[k + 1])]:
+                    where[row] = (number, block, row - offsets[k])
+        problems = [(*where[row], float(c['max_score'][row]), float(scores[row])) for row in bad]
+    else:
+        trials, keys = [], []
+        for fn in sorted(os.listdir(config_path)):
+            if not fn.endswith('.json'):
+                continue
+            with open(f'{config_path}/{fn}') as f:
+                conf = json.load(f)
+            for block, ts in conf['trials'].items():
+                trials.extend(ts)
+                keys.extend((fn, block, i) for i in range(len(ts)))
+        bad, scores = check_trials(trials)
+        n_trials = len(trials)
+        problems = [(*keys[i], trials[i]['max_score'], float(scores[i])) for i in bad]
+
+    for config, block, i, stored, solved in problems:
+        print(f'{config} {block} {i}: max_score is {stored}, should be {solved}')
+    print(f'{n_trials - len(problems)}/{n_trials} trials have the right max_score '
+          f'({time.perf_counter() - start_time:.2f}s)')
+    return not problems
+
+
+if __name__ == '__main__':
+    from fire import Fire
+    Fire({'validate': validate})
@@ -0,0 +1,77 @@
+import logging
+import numpy as np
+
+import graphics
+
+class FrameTimer(object):
+    """Tracks inter-flip intervals by stage and summarizes dropped/late frames.
+
+    frame_rate defaults to the rate measured when the window was set up.
+    Call new_segment() after anything that holds up flipping on purpose
+    (a blocking wait, tracker I/O); the gap before the next flip is then
+    not counted as dropped frames.
+    """
+    def __init__(self, frame_rate=None, late_tolerance=0.2, percentiles=(50, 95, 99)):
+        self.frame_rate = frame_rate or graphics.FRAME_RATE
+        self.frame_interval = 1 / self.frame_rate
+        self.late_tolerance = late_tolerance
+        self.percentiles = percentiles
+        self.times = []
+        self.stages = []
+        self.changes = []
+        self.segments = []
+        self.segment = 0
+
+    def new_segment(self):
+        self.segment += 1
+
+    def record(self, t, stage, changes=0):
+        """changes is the number of stimulus changes made before this flip."""
+        self.times.append(t)
+        self.stages.append(stage)
+        self.changes.append(changes)
+        self.segments.append(self.segment)
+
+    def __len__(self):
+        return len(self.times)
+
+    def _summarize(self, dt):
+        # number of vsyncs that passed without a flip
+        missed = np.maximum(np.round(dt / self.frame_interval) - 1, 0)
+        late = dt > (1 + self.late_tolerance) * self.frame_interval
+        ms = 1000 * dt
+        return {
+            'n_frames': len(dt),
+            'dropped': int(missed.sum()),
+            'late': int(late.sum()),
+            'mean_ms': round(float(ms.mean()), 3),
+            'max_ms': round(float(ms.max()), 3),
+            **{f'p{q}_ms': round(float(v), 3) for q, v in zip(self.percentiles, np.percentile(ms, self.percentiles))}
+        }
+
+    def summary(self):
+        if len(self.times) < 2:
+            return {'n_frames': 0, 'dropped': 0, 'late': 0, 'stages': {}}
+        # intervals that span a segment break aren't frames
+        keep = np.diff(self.segments) == 0
+        if not keep.any():
+            return {'n_frames': 0, 'dropped': 0, 'late': 0, 'stages': {}}
+        dt = np.diff(self.times)[keep]
+        # each interval is attributed to the stage of the flip that ends it
+        stages = np.array(self.stages[1:])[keep]
+        result = self._summarize(dt)
+        result['frame_rate'] = self.frame_rate
+        changes = np.array(self.changes)
+        result['state_changes'] = {'mean': round(float(changes.mean()), 3), 'max': int(changes.max()),
+                                   'idle_frames': int((changes == 0).sum())}
+        result['stages'] = {s: self._summarize(dt[stages == s]) for s in dict.fromkeys(stages)}
+        return result
+
+
+def check_frame_budget(summary, budget, name='trial'):
+    """Logs a warning if more than budget frames were dropped."""
+    if budget is not None and summary['dropped'] > budget:
+        by_stage = ', '.join(f"{s} = {x['dropped']}" for s, x in summary['stages'].items() if x['dropped'])
+        logging.warning(f"{name} dropped {summary['dropped']} frames (budget {budget}): {by_stage}")
+        return False
+    return True
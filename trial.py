@@ -9,22 +9,29 @@ wait = core.wait
 
 COLOR_PLAN = '#F2384A'
 COLOR_ACT = '#126DEF'
-
-from graphics import Graphics, FRAME_RATE
+COLOR_HIGHLIGHT = '#FFC910'
+TIMER_COLOR = -.2 * np.ones(3)
+TIMER_RED = np.array([1, -1, -1])
+
+import graphics
+from graphics import Graphics, Animator, STIMULUS_POOL, STATE_CHANGES, update
+from timing import FrameTimer, check_frame_budget
+from hittest import NodeIndex
+from buffers import ColumnBuffer, MouseTrace
+from fixation import make_detector
+from gaze_filter import make_filter
 
 def reward_string(r):
     return f'{int(r):+}' if r else ''
 
-def distance(p1, p2):
-    (x1, y1), (x2, y2) = (p1, p2)
-    return np.sqrt((x1 - x2)**2 + (y1 - y2)**2)
-
 class GraphTrial(object):
     """Graph navigation interface"""
     def __init__(self, win, graph, rewards, start, layout, plan_time=None, act_time=None, start_mode=None,
                  highlight_edges=False, stop_on_x=True, hide_rewards_while_acting=True, initial_stage='planning',
                  eyelink=None, gaze_contingent=False, gaze_tolerance=1.2, fixation_lag = .5, show_gaze=False,
-                 pos=(0, 0), space_start=True, max_score=None, **kws):
+                 fixation_detector=None, fixation_dispersion=.03, fixation_velocity=1., fixation_min_duration=.06,
+                 gaze_filter=None, gaze_prediction=None, batch_render=False,
+                 pos=(0, 0), space_start=True, max_score=None, dropped_frame_budget=10, mouse_trace='changes', **kws):
         self.win = win
         self.graph = graph
         self.rewards = list(rewards)
@@ -44,11 +51,22 @@ class GraphTrial(object):
         self.gaze_tolerance = gaze_tolerance
         self.fixation_lag = fixation_lag
         self.show_gaze = show_gaze
+        self.batch_render = batch_render
         self.last_gaze = None
+        if fixation_detector == 'idt':
+            self.fixation_detector = make_detector('idt', dispersion=fixation_dispersion, min_duration=fixation_min_duration)
+        elif fixation_detector == 'ivt':
+            self.fixation_detector = make_detector('ivt', velocity=fixation_velocity, min_duration=fixation_min_duration)
+        else:
+            self.fixation_detector = None
+        self.gaze_filter = None if gaze_filter is None else make_filter(gaze_filter)
+        self.gaze_prediction = gaze_prediction
 
         self.pos = pos
         self.space_start = space_start
         self.max_score = max_score
+        self.dropped_frame_budget = dropped_frame_budget
+        self.frame_timer = FrameTimer()
 
         # all for current stage
         self.stage = initial_stage
@@ -60,7 +78,9 @@ class GraphTrial(object):
         self.disable_click = False
         self.score = 0
         self.current_state = None
+        self.highlighted_state = None
         self.fixated = None
+        self.fixated_since = None
         self.fix_verified = None
         self.data = {
             "trial": {
@@ -68,18 +88,26 @@ class GraphTrial(object):
                 "graph": graph,
                 "rewards": rewards,
                 "start": start,
+                "pos": pos,
                 "plan_time": plan_time,
                 "act_time": act_time,
                 "gaze_contingent": gaze_contingent,
                 "gaze_tolerance": gaze_tolerance,
-                "fixation_lag": fixation_lag
+                "fixation_lag": fixation_lag,
+                "fixation_detector": fixation_detector,
+                "fixation_dispersion": fixation_dispersion,
+                "fixation_velocity": fixation_velocity,
+                "fixation_min_duration": fixation_min_duration,
+                "gaze_filter": gaze_filter,
+                "gaze_prediction": gaze_prediction,
             },
             "events": [],
-            "flips": [],
-            "mouse": [],
+            "flips": ColumnBuffer(['time']),
+            "mouse": MouseTrace(mouse_trace),
         }
         logging.debug("begin trial " + jsonify(self.data["trial"]))
         self.gfx = Graphics(win)
+        self.animations = Animator(win)
         self.mouse = event.Mouse()
         self.done = False
 
@@ -94,7 +122,7 @@ class GraphTrial(object):
         }
         self.data["events"].append(datum)
         if self.eyelink:
-            self.eyelink.message(jsonify(datum), log=False)
+            self.eyelink.message(datum, log=False)  # encoded on the sender thread
 
 
     def show(self):
@@ -105,38 +133,57 @@ class GraphTrial(object):
                 self.update_fixation()
             return
 
-        self.nodes = nodes = []
-        for i, (x, y) in enumerate(self.layout):
-            nodes.append(self.gfx.circle(0.7 * np.array([x, y]), name=f'node{i}', r=.04))
+        # stimuli are shared by all trials with the same layout and position
+        self.board = board = STIMULUS_POOL.get(self.win, self.layout, self.pos, batched=self.batch_render)
+        board.reset()
+        board.prerender(self.label_strings())
+        self.nodes = board.nodes
         self.data["trial"]["node_positions"] = [height2pix(self.win, n.pos) for n in self.nodes]
 
-        self.reward_labels = [self.gfx.text('', n.pos, height=.04, name=f'lab{i}') for i, n in enumerate(self.nodes)]
+        self.reward_labels = board.labels
         self.update_node_labels()
 
         self.arrows = {}
         for i, js in enumerate(self.graph):
             for j in js:
-                self.arrows[(i, j)] = self.gfx.arrow(nodes[i], nodes[j])
-
+                self.arrows[(i, j)] = board.arrow(i, j)
 
+        self.gfx.objects = [*board.objects, *self.nodes, *self.reward_labels, *self.arrows.values()]
         if self.plan_time is not None or self.act_time is not None:
-            self.timer_wrap = self.gfx.rect((0.5,-0.45), .02, 0.9, anchor='bottom', color=-.1)
-            self.timer = self.gfx.rect((0.5,-0.45), .02, 0.9, anchor='bottom', color=-.2)
+            self.timer_wrap = board.timer_wrap
+            self.timer = board.timer
+            self.gfx.objects += [self.timer_wrap, self.timer]
         else:
             self.timer = None
 
-        self.mask = self.gfx.rect((.1,0), 1.1, 1, color='gray', opacity=0)
-        self.gfx.shift(*self.pos)
+        self.mask = board.mask
+        self.gfx.objects.append(self.mask)
+        self.gfx.show()
+        self.highlighted_state = None
+        self.build_node_index()
 
         if self.show_gaze:
             self.gaze_dot = self.gfx.circle((0,0), .005, color='red', lineWidth=1, lineColor="red")
 
+    def label_strings(self):
+        """Every string a reward label can show in this trial."""
+        return {reward_string(r) for r in self.rewards} | {'?'}
+
+    def build_node_index(self):
+        centers = [n.pos for n in self.nodes]
+        radii = np.array([n.radius for n in self.nodes])
+        self.click_index = NodeIndex(centers, radii)
+        self.gaze_index = NodeIndex(centers, self.gaze_tolerance * radii)
+
     def hide(self):
         self.gfx.clear()
 
     def shift(self, x, y):
-        self.gfx.shift(x, y)
         self.pos = np.array(self.pos) + [x, y]
+        if hasattr(self, 'nodes'):
+            self.board.shift(x, y)
+            self.click_index.shift(x, y)
+            self.gaze_index.shift(x, y)
 
 
     def set_reward(self, s, r):
@@ -145,14 +192,11 @@ class GraphTrial(object):
 
     def get_click(self):
         if self.mouse.getPressed()[0]:
-            pos = self.mouse.getPos()
-            for (i, n) in enumerate(self.nodes):
-                if n.contains(pos):
-                    return i
+            return self.click_index.find(self.mouse.getPos())
 
     def set_state(self, s):
         self.log('visit', {'state': s})
-        self.nodes[s].fillColor = COLOR_PLAN if self.stage == 'planning' else COLOR_ACT
+        update(self.nodes[s], 'fillColor', COLOR_PLAN if self.stage == 'planning' else COLOR_ACT)
         lab = self.reward_labels[s]
         self.score += self.rewards[s]
         prev = self.current_state
@@ -164,18 +208,22 @@ class GraphTrial(object):
             self.done = True
 
         if prev is not None and prev != s:  # not initial
-            self.nodes[prev].fillColor = 'white'
+            update(self.nodes[prev], 'fillColor', 'white')
             lab.color = 'white'
             # lab.bold = True
-            for p in self.gfx.animate(6/60):
-                lab.setHeight(0.04 + p * 0.02)
-                self.tick()
-            for p in self.gfx.animate(12/60):
-                lab.setHeight(0.06 - p * 0.05)
-                lab.setOpacity(1-p)
-                self.tick()
-
-        lab.setText('')
+            self.pop_label(lab, .01, then=lambda: lab.setText(''))
+        else:
+            lab.setText('')
+
+    def pop_label(self, lab, final_height, key=None, then=None):
+        """Grows the label, then shrinks it to final_height while fading it out."""
+        key = lab if key is None else key
+        def shrink(p):
+            lab.setHeight(.06 - p * (.06 - final_height))
+            lab.setOpacity(1 - p)
+        def fade():
+            self.animations.start(shrink, .2, key=key, then=then)
+        self.animations.tween(lab.setHeight, .04, .06, .1, key=key, then=fade)
 
     def click(self, s):
         if s in self.graph[self.current_state]:
@@ -184,13 +232,25 @@ class GraphTrial(object):
     def is_done(self):
         return len(self.graph[self.current_state]) == 0
 
+    def finish_animations(self):
+        while self.animations:
+            self.update_fixation()
+            self.tick()
+
+    def pause(self, sec):
+        """Like wait, but keeps flipping and reading gaze."""
+        end = core.getTime() + sec
+        while core.getTime() < end:
+            self.update_fixation()
+            self.tick()
+
     def fade_out(self):
-        for p in self.gfx.animate(.2):
-            self.mask.setOpacity(p)
-            self.win.flip()
+        self.end_time = None  # freeze the timer
+        self.stage = 'fade_out'
+        self.animations.tween(self.mask.setOpacity, 0, 1, .2)
+        self.finish_animations()
         self.gfx.clear()
-        self.win.flip()
-        wait(.3)
+        self.pause(.3)
 
     def node_label(self, i):
         if self.gaze_contingent:
@@ -218,32 +278,79 @@ class GraphTrial(object):
     def update_fixation(self):
         if not self.eyelink:
             return
-        gaze = self.eyelink.gaze_position()
-
-        if self.last_gaze is not None:
-            gaze_distance = distance(gaze, self.last_gaze)
-        self.last_gaze = gaze
-
-        if self.show_gaze:
-            self.gaze_dot.setPos(gaze)
+        # every sample since the last frame, not just the newest one
+        samples = self.eyelink.read_samples()
+        if self.gaze_filter is not None:
+            samples = self.gaze_filter(samples)
         self.last_fixated = self.fixated
+        if len(samples):
+            self.last_gaze = gaze = samples[-1, 1:]
+            if self.show_gaze:
+                self.gaze_dot.setPos(gaze)
+
+        # the detectors only ever see measured samples
+        if self.fixation_detector is not None:
+            self.detect_fixations(samples)
+        else:
+            self.threshold_fixations(samples)
 
-        for i in range(len(self.nodes)):
-            if distance(gaze, self.nodes[i].pos) < self.gaze_tolerance * self.nodes[i].radius:
+        if len(samples) and self.gaze_filter is not None and self.gaze_prediction is not None:
+            self.predict_fixation()
 
+        if self.gaze_contingent and self.last_fixated != self.fixated:
+            self.update_node_labels()
 
-                if self.fixated != i:
-                    self.log('fixate state', {'state': i})
-                self.fixated = i
-                self.fix_verified = core.getTime()
-                break
+    def threshold_fixations(self, samples):
+        """A node is fixated while some sample lands within gaze_tolerance of it every fixation_lag seconds."""
+        i = None
+        if len(samples):
+            hits = self.gaze_index.find_all(samples[:, 1:])
+            hits = hits[hits >= 0]
+            if len(hits):
+                i = int(hits[-1])
+
+        if i is not None:
+            if self.fixated != i:
+                self.log('fixate state', {'state': i})
+            self.fixated = i
+            self.fix_verified = core.getTime()
 
         if self.fixated is not None and core.getTime() - self.fix_verified > self.fixation_lag:
             self.log('unfixate state', {'state': self.fixated})
             self.fixated = None
 
-        if self.gaze_contingent and self.last_fixated != self.fixated:
-            self.update_node_labels()
+    def detect_fixations(self, samples):
+        """A node is fixated from the start to the end of a detected fixation whose centroid lands on it."""
+        for e in self.fixation_detector.update(samples):
+            if e.kind == 'start':
+                i = self.gaze_index.find((e.x, e.y))
+                if i is not None:
+                    if i != self.fixated:
+                        self.log('fixate state', {'state': i, 'gaze_time': e.time})
+                    self.fixated = i
+                    self.fixated_since = e.time
+            # a fixation that ended before a predicted one began isn't the one on the fixated node
+            elif self.fixated is not None and e.time >= self.fixated_since:
+                self.log('unfixate state', {'state': self.fixated, 'gaze_time': e.time})
+                self.fixated = None
+
+    def predict_fixation(self):
+        """Fixates the node the gaze is predicted to be on when the next frame is shown.
+
+        gaze_prediction is the display's latency past the flip, in seconds.
+        """
+        t = self.eyelink.tracker_time(self.win.lastFrameT + 1 / graphics.FRAME_RATE + self.gaze_prediction)
+        if t is None:
+            return
+        predicted = self.gaze_filter.predict(t)
+        i = self.gaze_index.find(predicted)
+        if i is None:
+            return
+        if i != self.fixated:
+            self.log('fixate state', {'state': i, 'predicted': True, 'gaze_time': t})
+        self.fixated = i
+        self.fixated_since = t
+        self.fix_verified = core.getTime()
 
     def check_click(self):
         if self.disable_click:
@@ -254,15 +361,18 @@ class GraphTrial(object):
             return True
 
     def highlight_current_edges(self):
+        if self.highlighted_state == self.current_state:
+            return
+        self.highlighted_state = self.current_state
         for (i, j), arrow in self.arrows.items():
             if i == self.current_state:
-                arrow.setColor('#FFC910')
-                arrow.objects[0].setDepth(1)  # make sure the line is on top
-                self.nodes[j].setLineColor('#FFC910')
+                update(arrow, 'setColor', COLOR_HIGHLIGHT)
+                update(arrow, 'setDepth', 1)  # make sure the line is on top
+                update(self.nodes[j], 'setLineColor', COLOR_HIGHLIGHT)
             else:
-                arrow.setColor('black')
-                arrow.objects[0].setDepth(2)
-                self.nodes[j].setLineColor('black')
+                update(arrow, 'setColor', 'black')
+                update(arrow, 'setDepth', 2)
+                update(self.nodes[j], 'setLineColor', 'black')
 
     def tick(self):
         self.current_time = core.getTime()
@@ -270,30 +380,41 @@ class GraphTrial(object):
             time_left = self.end_time - self.current_time
             if time_left > 0:
                 p = time_left / (self.end_time - self.start_time)
-                self.timer.setHeight(0.9 * p)
+                px = self.win.size[1]  # only update when the bar changes by a pixel
+                update(self.timer, 'setHeight', round(0.9 * p * px) / px)
                 if self.stage == 'acting' and time_left < 3:
                     p2 = time_left / 3
-                    original = -.2 * np.ones(3)
-                    red = np.array([1, -1, -1])
-                    self.timer.setColor(p2 * original + (1-p2) * red)
+                    update(self.timer, 'setColor', p2 * TIMER_COLOR + (1-p2) * TIMER_RED)
+        self.animations.step()
         self.last_flip = t = self.win.flip()
-        self.data["mouse"].append(self.mouse.getPos())
+        self.data["mouse"].record(t, self.mouse.getPos())
         self.data["flips"].append(t)
+        self.frame_timer.record(t, 'animation' if self.gfx.animating or self.animations else self.stage, STATE_CHANGES.reset())
         return t
 
+    def summarize_frames(self):
+        summary = self.data["frame_timing"] = self.frame_timer.summary()
+        if self.gaze_filter is not None:
+            self.data["gaze_filter"] = self.gaze_filter.stats()
+        logging.debug('frame timing ' + jsonify(summary))
+        check_frame_budget(summary, self.dropped_frame_budget, self.__class__.__name__)
+        return summary
+
     def do_timeout(self):
+        """Blinks the timer three times, then makes random choices until the trial is done."""
         self.log('timeout')
         logging.info('timeout')
-        for i in range(3):
-            self.timer_wrap.setColor('red'); self.win.flip()
-            wait(0.3)
-            self.timer_wrap.setColor(-.2); self.win.flip()
-            wait(0.3)
+        self.end_time = None
+        self.disable_click = True
+        def blink(p):
+            update(self.timer_wrap, 'setColor', 'red' if p < 1 and int(6 * p) % 2 == 0 else -.2)
+        self.animations.start(blink, 1.8, key='timeout', then=self.random_choice)
 
-        # random choices
-        while not self.done:
-            self.set_state(np.random.choice(self.graph[self.current_state]))
-            core.wait(.5)
+    def random_choice(self):
+        self.set_state(np.random.choice(self.graph[self.current_state]))
+        if not self.done:
+            # the label pop plus half a second
+            self.animations.after(.8, self.random_choice, key='timeout')
 
     def start_recording(self):
         self.log('start recording')
@@ -311,7 +432,7 @@ class GraphTrial(object):
     def run_planning(self):
         self.log('start planning')
         self.stage = 'planning'
-        self.nodes[self.current_state].fillColor = COLOR_PLAN
+        update(self.nodes[self.current_state], 'fillColor', COLOR_PLAN)
         self.start_time = self.current_time = core.getTime()
         self.end_time = None if self.plan_time is None else self.start_time + self.plan_time
 
@@ -343,13 +464,14 @@ class GraphTrial(object):
 
         self.fixated = None
         self.win.flip()
+        self.frame_timer.new_segment()  # the flip above isn't recorded
 
     def hide_rewards(self):
         for i in range(len(self.nodes)):
             self.set_node_label(i, '')
 
     def run_acting(self, one_step):
-        self.nodes[self.current_state].fillColor = COLOR_ACT
+        update(self.nodes[self.current_state], 'fillColor', COLOR_ACT)
         self.log('start acting')
         if self.hide_rewards_while_acting:
             self.hide_rewards()
@@ -405,14 +527,19 @@ class GraphTrial(object):
         if not self.done:
             self.run_acting(one_step)
             if one_step:
+                self.finish_animations()
                 return
 
+        self.finish_animations()
+
         self.log('done')
         logging.debug("end trial " + jsonify(self.data["events"]))
         if self.eyelink:
             self.eyelink.stop_recording()
-        wait(.3)
+            self.frame_timer.new_segment()
+        self.pause(.3)
         self.fade_out()
+        self.summarize_frames()
         return self.status
 
 
@@ -439,6 +566,9 @@ class CalibrationTrial(GraphTrial):
 
         super().__init__(*args, **kwargs)
 
+    def label_strings(self):
+        return {'O', 'X'}
+
     def node_label(self, i):
         return {
             # self.completed: ''
@@ -455,33 +585,69 @@ class CalibrationTrial(GraphTrial):
         if self.arrow is not None:
             self.arrow.setAutoDraw(False)
         if self.last_target is not None:
-            self.arrow = self.gfx.arrow(self.nodes[self.last_target], self.nodes[self.target])
+            self.arrow = self.board.arrow(self.last_target, self.target)
+            self.arrow.setAutoDraw(True)
+            if self.arrow not in self.gfx.objects:
+                self.gfx.objects.append(self.arrow)
 
     def new_target(self):
         initial = self.target is None
         self.last_target = self.target
 
-        if initial:
-            self.target = np.random.choice(len(self.successes))
-        else:
-            p = np.exp(
-                -5 * self.successes +
-                self.all_failures[:len(self.successes)]
-            )
-            p[self.target] = 0
-            p /= (sum(p) or 1)  # prevent divide by 0
-            self.target = np.random.choice(len(p), p=p)
-
+        self.target = self.choose_target(initial)
         self.target_time = 'flip'  # updated to be next flip time
         self.draw_arrow()
         self.update_node_labels()
         self.log('new target', {"state": self.target})
 
+    def choose_target(self, initial):
+        if initial:
+            return np.random.choice(len(self.successes))
+        p = np.exp(
+            -5 * self.successes +
+            self.all_failures[:len(self.successes)]
+        )
+        p[self.target] = 0
+        p /= (sum(p) or 1)  # prevent divide by 0
+        return np.random.choice(len(p), p=p)
+
     def tick(self):
         t = super().tick()
         if self.target_time == 'flip':
             self.target_time = t
 
+    def show_failure(self):
+        self.set_node_label(self.target, 'X')
+        lab = self.reward_labels[self.target]
+        def blink(p):
+            lab.setOpacity(1 - int(6 * p) % 2 if p < 1 else 0)  # three times
+        def done():
+            if self.result is not None:
+                return  # cancelled during the feedback
+            lab.setOpacity(1)
+            if sum(self.failures) == self.n_fail or self.failures[self.target] == 2:
+                self.result = 'failure'
+            else:
+                self.new_target()
+        self.animations.start(blink, 1, key='feedback',
+                              then=lambda: self.animations.after(self.target_delay, done, key='feedback'))
+
+    def show_success(self):
+        lab = self.reward_labels[self.target]
+        def done():
+            if self.result is not None:
+                return  # cancelled during the feedback
+            lab.setOpacity(1)
+            lab.setHeight(.03)
+            if self.successes[self.target] == self.n_success:
+                self.uncomplete.remove(self.target)
+            if self.uncomplete:
+                self.new_target()
+            else:
+                self.result = 'success'
+        self.pop_label(lab, .03, key='feedback',
+                       then=lambda: self.animations.after(self.target_delay, done, key='feedback'))
+
     def run(self, timeout=15):
         assert self.eyelink
         # self.eyelink.drift_check(self.pos)
@@ -503,46 +669,19 @@ class CalibrationTrial(GraphTrial):
                 self.log('cancel')
                 self.result = 'cancelled'
 
+            elif 'feedback' in self.animations:
+                pass  # gaze is still read, but the target is on hold
+
             elif self.last_flip > self.target_time + self.saccade_time:  # timeout
                 self.log('timeout', {"state": self.target})
                 self.failures[self.target] += 1
                 self.all_failures[self.target] += 1
-
-                self.set_node_label(self.target, 'X')
-                lab = self.reward_labels[self.target]
-                for p in range(FRAME_RATE):
-                    lab.setOpacity(1 - (p // 10) % 2)
-                    self.tick()
-                wait(self.target_delay)
-                lab.setOpacity(1)
-
-                if sum(self.failures) == self.n_fail or self.failures[self.target] == 2:
-                    self.result = 'failure'
-                else:
-                    self.new_target()
+                self.show_failure()
 
             elif self.fixated == self.target:  # fixated within time
                 self.log('fixated target', {"state": self.target})
                 self.successes[self.target] += 1
-
-                lab = self.reward_labels[self.target]
-                for p in self.gfx.animate(6/60):
-                    lab.setHeight(0.04 + p * 0.02)
-                    self.tick()
-                for p in self.gfx.animate(12/60):
-                    lab.setHeight(0.06 - p * 0.03)
-                    lab.setOpacity(1-p)
-                    self.tick()
-                wait(self.target_delay)
-                lab.setOpacity(1)
-                lab.setHeight(.03)
-
-                if self.successes[self.target] == self.n_success:
-                    self.uncomplete.remove(self.target)
-                if self.uncomplete:
-                    self.new_target()
-                else:
-                    self.result = 'success'
+                self.show_success()
 
             # if not self.done and self.end_time is not None and self.start_time + self.end_time < core.getTime():
             #     self.do_timeout()
@@ -550,10 +689,13 @@ class CalibrationTrial(GraphTrial):
 
             t = self.tick()
 
+        self.finish_animations()
         self.log('done')
         self.eyelink.stop_recording()
-        wait(.3)
+        self.frame_timer.new_segment()
+        self.pause(.3)
         self.fade_out()
+        self.summarize_frames()
         self.win.mouseVisible = True
 
         return self.result
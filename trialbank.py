@@ -0,0 +1,259 @@
+"""Packs a version's config files into one memory-mapped trial bank.
+
+    python trialbank.py compile config/e3     # writes config/e3.bank/
+    python trialbank.py check config/e3       # compares the bank with the JSON files
+
+A bank is a directory of .npy arrays with one row per trial (graph, rewards,
+start, n_steps, max_score, gaze_contingent), padded to the largest graph,
+plus meta.json holding the parameters shared by every config and an offset
+index giving each config's rows for each block. Arrays are memory-mapped,
+so loading a participant's trials parses no JSON and reads only the rows
+that are used. meta.json also records the size, mtime and hash of each
+source file; a bank whose JSON files have since changed is not used.
+"""
+import os
+import json
+import hashlib
+import logging
+from collections.abc import Sequence
+import numpy as np
+
+COLUMNS = ('graph', 'n_nodes', 'rewards', 'start', 'n_steps', 'max_score', 'gaze_contingent')
+
+
+def bank_path(config_path):
+    return config_path.rstrip('/') + '.bank'
+
+
+def _compact(x):
+    """x as the smallest dtype that holds it exactly."""
+    x = np.asarray(x)
+    for dtype in (np.int8, np.int16, np.int32, np.float32):
+        with np.errstate(all='ignore'):
+            y = x.astype(dtype)
+        if np.array_equal(y, x):
+            return y
+    return x.astype(np.float64)
+
+
+def _config_numbers(config_path):
+    names = [os.path.splitext(fn)[0] for fn in os.listdir(config_path) if fn.endswith('.json')]
+    return sorted(int(n) for n in names if n.isdigit())
+
+
+def _source(path, data):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': hashlib.sha1(data).hexdigest()}
+
+
+def changed_sources(config_path, sources):
+    """Names of the config files added, removed or edited since the bank recorded sources."""
+    current = {f'{n}.json' for n in _config_numbers(config_path)}
+    changed = set(current) ^ set(sources)
+    for fn in current & set(sources):
+        st = os.stat(f'{config_path}/{fn}')
+        rec = sources[fn]
+        if (st.st_size, st.st_mtime_ns) == (rec['size'], rec['mtime_ns']):
+            continue
+        # touched, e.g. by a checkout; only a change in content counts
+        with open(f'{config_path}/{fn}', 'rb') as f:
+            if hashlib.sha1(f.read()).hexdigest() != rec['sha1']:
+                changed.add(fn)
+    return sorted(changed)
+
+
+def compile_bank(config_path, out=None):
+    """Writes the bank for the numbered JSON configs in config_path."""
+    out = out or bank_path(config_path)
+    numbers = _config_numbers(config_path)
+    configs = []
+    sources = {}
+    for number in numbers:
+        path = f'{config_path}/{number}.json'
+        with open(path, 'rb') as f:
+            data = f.read()
+        configs.append(json.loads(data))
+        sources[f'{number}.json'] = _source(path, data)
+
+    blocks = list(configs[0]['trials'])
+    shared = dict(configs[0]['parameters'])
+    for conf in configs[1:]:
+        shared = {k: v for k, v in shared.items() if conf['parameters'].get(k, object()) == v}
+    overrides = {}
+    for number, conf in zip(numbers, configs):
+        if set(conf['trials']) != set(blocks):
+            raise ValueError(f'config {number} has blocks {list(conf["trials"])}, not {blocks}')
+        extra = {k: v for k, v in conf['parameters'].items() if k not in shared}
+        if extra:
+            overrides[str(number)] = extra
+
+    trials = [t for conf in configs for b in blocks for t in conf['trials'][b]]
+    known = {'graph', 'rewards', 'start', 'n_steps', 'max_score', 'gaze_contingent'}
+    unknown = {k for t in trials for k in t} - known
+    if unknown:
+        raise ValueError(f'trial keys {unknown} have no column in the bank')
+
+    n_nodes = np.array([len(t['graph']) for t in trials])
+    max_nodes = n_nodes.max()
+    max_children = max(len(c) for t in trials for c in t['graph'])
+    graph = np.full((len(trials), max_nodes, max_children), -1)
+    rewards = np.zeros((len(trials), max_nodes))
+    for i, t in enumerate(trials):
+        for j, children in enumerate(t['graph']):
+            graph[i, j, :len(children)] = children
+        rewards[i, :len(t['rewards'])] = t['rewards']
+    columns = {
+        'graph': graph,
+        'n_nodes': n_nodes,
+        'rewards': rewards,
+        'start': [t['start'] for t in trials],
+        'n_steps': [t['n_steps'] for t in trials],
+        'max_score': [t['max_score'] for t in trials],
+        # -1 where the trial doesn't set it
+        'gaze_contingent': [int(t['gaze_contingent']) if 'gaze_contingent' in t else -1 for t in trials],
+    }
+
+    # config i's rows for block k are offsets[i, k] to offsets[i, k+1]
+    sizes = [len(conf['trials'][b]) for conf in configs for b in blocks]
+    ends = np.concatenate([[0], np.cumsum(sizes)])
+    nb = len(blocks)
+    offsets = np.array([ends[i * nb:(i + 1) * nb + 1] for i in range(len(configs))])
+
+    os.makedirs(out, exist_ok=True)
+    for name in COLUMNS:
+        np.save(f'{out}/{name}.npy', _compact(columns[name]))
+    np.save(f'{out}/offsets.npy', offsets.astype(np.int64))
+    meta = {
+        'source': config_path,
+        'configs': numbers,
+        'blocks': blocks,
+        'parameters': shared,
+        'parameter_overrides': overrides,
+        'n_trials': len(trials),
+        'sources': sources,
+    }
+    with open(f'{out}/meta.json', 'w') as f:
+        json.dump(meta, f)
+    size = sum(os.path.getsize(f'{out}/{fn}') for fn in os.listdir(out))
+    print(f'{len(numbers)} configs, {len(trials)} trials -> {out} ({size / 1e6:.1f} MB)')
+    return out
+
+
+class TrialList(Sequence):
+    """A config's trials for one block, decoded from the bank as they are used."""
+    def __init__(self, bank, start, stop):
+        self.bank = bank
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            return TrialList(self.bank, self.start + start, self.start + max(start, stop))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('trial index out of range')
+        return self.bank.trial(self.start + i)
+
+    def __repr__(self):
+        return f'TrialList({len(self)} trials)'
+
+
+class TrialBank(object):
+    def __init__(self, path):
+        self.path = path
+        with open(f'{path}/meta.json') as f:
+            self.meta = json.load(f)
+        self.columns = {name: np.load(f'{path}/{name}.npy', mmap_mode='r') for name in COLUMNS}
+        self.offsets = np.load(f'{path}/offsets.npy', mmap_mode='r')
+        self.index = {n: i for i, n in enumerate(self.meta['configs'])}
+
+    @property
+    def fingerprint(self):
+        """Identifies the contents of the source files the bank was compiled from."""
+        sources = self.meta.get('sources', {})
+        return hashlib.sha1(json.dumps({fn: s['sha1'] for fn, s in sources.items()}, sort_keys=True).encode()).hexdigest()
+
+    @property
+    def config_numbers(self):
+        return self.meta['configs']
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, number):
+        return int(number) in self.index
+
+    def trial(self, row):
+        c = self.columns
+        n = int(c['n_nodes'][row])
+        trial = {
+            'graph': [[int(j) for j in children if j >= 0] for children in c['graph'][row, :n].tolist()],
+            'rewards': [float(r) for r in c['rewards'][row, :n]],
+            'start': int(c['start'][row]),
+            'n_steps': int(c['n_steps'][row]),
+            'max_score': float(c['max_score'][row]),
+        }
+        gaze_contingent = int(c['gaze_contingent'][row])
+        if gaze_contingent >= 0:
+            trial['gaze_contingent'] = bool(gaze_contingent)
+        return trial
+
+    def parameters(self, number):
+        return {**self.meta['parameters'], **self.meta['parameter_overrides'].get(str(number), {})}
+
+    def trials(self, number):
+        """{block: TrialList} for config number."""
+        offsets = self.offsets[self.index[int(number)]]
+        return {b: TrialList(self, int(offsets[k]), int(offsets[k + 1]))
+                for k, b in enumerate(self.meta['blocks'])}
+
+    def load(self, number):
+        """Config number in the same form as its JSON file, with lazy trial lists."""
+        return {'parameters': self.parameters(number), 'trials': self.trials(number)}
+
+
+def load_bank(config_path):
+    """The bank compiled from config_path, or None if there isn't one or it is out of date."""
+    path = bank_path(config_path)
+    if not os.path.isfile(f'{path}/meta.json'):
+        return None
+    bank = TrialBank(path)
+    if not os.path.isdir(config_path):
+        return bank  # shipped without the JSON files
+    if 'sources' not in bank.meta:
+        logging.warning('%s predates source tracking; using the JSON configs (run make banks)', path)
+        return None
+    changed = changed_sources(config_path, bank.meta['sources'])
+    if changed:
+        logging.warning('%s is out of date (%s changed); using the JSON configs (run make banks)',
+                        path, ', '.join(changed[:5]) + (f' and {len(changed) - 5} more' if len(changed) > 5 else ''))
+        return None
+    return bank
+
+
+def check(config_path):
+    """Checks that every config in the bank matches its JSON file."""
+    bank = TrialBank(bank_path(config_path))
+    bad = 0
+    for number in bank.config_numbers:
+        with open(f'{config_path}/{number}.json') as f:
+            conf = json.load(f)
+        loaded = bank.load(number)
+        loaded['trials'] = {b: list(ts) for b, ts in loaded['trials'].items()}
+        if loaded != conf:
+            print(f'config {number} differs')
+            bad += 1
+    print(f'{len(bank) - bad}/{len(bank)} configs match')
+    return bad == 0
+
+
+if __name__ == '__main__':
+    from fire import Fire
+    Fire({'compile': compile_bank, 'check': check})
@@ -1,7 +1,12 @@
+import os
+import sys
 import json
 import logging
+import subprocess
 import numpy as np
 
+from buffers import ColumnBuffer
+
 class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.ndarray):
@@ -10,6 +15,8 @@ class NumpyEncoder(json.JSONEncoder):
             return int(obj)
         elif isinstance(obj, np.float64):
             return float(obj)
+        elif isinstance(obj, ColumnBuffer):
+            return obj.tolist()
 
         return json.JSONEncoder.default(self, obj)
 
@@ -20,6 +27,43 @@ def jsonify(obj):
         logging.exception("Error converting json, falling back on string")
         return str(obj)
 
+def git_sha(path='.'):
+    """The commit checked out at path, read from .git without starting git."""
+    git = os.path.join(path, '.git')
+    try:
+        with open(os.path.join(git, 'HEAD')) as f:
+            head = f.read().strip()
+        if not head.startswith('ref: '):
+            return head  # detached
+        ref = head[5:]
+        if os.path.isfile(os.path.join(git, ref)):
+            with open(os.path.join(git, ref)) as f:
+                return f.read().strip()
+        with open(os.path.join(git, 'packed-refs')) as f:
+            for line in f:
+                if line.rstrip().endswith(' ' + ref):
+                    return line.split()[0]
+    except OSError:
+        pass
+    # e.g. a worktree, where .git is a file
+    return subprocess.getoutput(f'git -C {path} rev-parse HEAD')
+
+def import_times(module, top=15):
+    """(package, seconds) spent importing each top-level package when importing module, slowest first.
+
+    Runs python -X importtime in a new interpreter, so nothing is already imported.
+    """
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                         capture_output=True, text=True).stderr
+    totals = {}
+    for line in out.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        totals[package] = totals.get(package, 0) + int(self_us) / 1e6
+    return sorted(totals.items(), key=lambda x: -x[1])[:top]
+
 
 if __name__ == '__main__':
     print(jsonify({